@@ -1,18 +1,40 @@
 #!/usr/bin/env python3
+import asyncio
 import atexit
+import bisect
 import clingo
+import concurrent.futures
+import contextlib
+import contextvars
 import enum
+import functools
+import io
 import json
+import math
 import os
 import re
 import readline
 import sh  # type: ignore
+import signal
+import socketserver
 import sys
-from typing import cast, Dict, List, Optional
+import threading
+import time
+import traceback
+from typing import (cast, Any, Callable, Dict, FrozenSet, Iterable, Iterator,
+                    List, Optional, Sequence, Set, TextIO, Tuple, Union)
 
 import ldcs
 
 
+try:
+    # since clingo 5.5, #script (python) must be enabled explicitly when
+    # running the solver in-process
+    from clingo.script import enable_python
+    enable_python()
+except ImportError:
+    pass
+
 readline.parse_and_bind('tab: complete')
 
 try:
@@ -23,6 +45,99 @@ except FileNotFoundError:
 
 atexit.register(readline.write_history_file, 'history.log')
 
+cache = ldcs.Cache('ldcs.cache')
+atexit.register(cache.save)
+
+Data = Tuple[clingo.Symbol, ...]
+Row = Tuple[str, List[Union[int, str]]]
+
+
+def read_csv(f: TextIO) -> Iterator[Row]:
+    rows = 0
+    for r, line in enumerate(f):
+        rows += 1
+        cols = 0
+        for c, v in enumerate(line.split(',')):
+            cols += 1
+            yield 'csv', [value(v.strip()), r+1, c+1]
+        yield 'csv_cols', [cols, r+1]
+    yield 'csv_rows', [rows]
+
+
+def read_txt(f: TextIO) -> Iterator[Row]:
+    name = os.path.basename(f.name)[:-4]
+    for line in f:
+        k, v = line.split()
+        yield name, [value(v), value(k)]
+
+
+def value(v: str) -> Union[int, str]:
+    return int(v) if re.fullmatch(r'-?\d+', v) else v
+
+
+class Snapshots:
+    """Facts read from data files, kept on disk between sessions.
+
+    The rows of a file are stored as JSON, with numbers as integers and
+    other values as the text of their terms, and reused until the file is
+    modified. Values that aren't terms, like `x y` or an empty cell, are
+    read as strings.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: Dict[str, Tuple[int, List[Row]]] = {}
+        self.loaded: Dict[str, Tuple[int, Data]] = {}
+        self.terms: Dict[str, clingo.Symbol] = {}
+        self.changed = False
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def load(self, path: str,
+             read: Callable[[TextIO], Iterator[Row]]) -> Data:
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        if path in self.loaded and self.loaded[path][0] == mtime:
+            return self.loaded[path][1]
+        if path in self.entries and self.entries[path][0] == mtime:
+            rows = self.entries[path][1]
+        else:
+            with open(path, 'r') as f:
+                rows = list(read(f))
+            self.entries[path] = mtime, rows
+            self.changed = True
+        data = tuple(clingo.Function(name, [self.term(v) for v in args])
+                     for name, args in rows)
+        self.loaded[path] = mtime, data
+        return data
+
+    def term(self, v: Union[int, str]) -> clingo.Symbol:
+        if isinstance(v, int):
+            return clingo.Number(v)
+        if v not in self.terms:
+            try:
+                self.terms[v] = clingo.parse_term(
+                    v, logger=lambda code, message: None)
+            except RuntimeError:
+                self.terms[v] = clingo.String(v)
+        return self.terms[v]
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + '.tmp', self.path)
+        self.changed = False
+
+
+snapshots = Snapshots('data.cache')
+atexit.register(snapshots.save)
+
 
 class ClingoExitCode(enum.IntFlag):
     # https://github.com/potassco/clasp/issues/42
@@ -35,42 +150,1306 @@ class ClingoExitCode(enum.IntFlag):
     NO_RUN = 128  # Search not started because of syntax or command line error.
 
 
-def run_clingo(lp: str) -> List[str]:
-    result = json.loads(sh.clingo(
-        outf=2, time_limit=5, _in=lp,
-        _err=sys.stderr if 'DEBUG' in os.environ else None,
-        _ok_code=[
-            ClingoExitCode.SAT,
-            ClingoExitCode.SAT | ClingoExitCode.EXHAUST
-        ]).stdout)
+class ClingoError(Exception):
+    def __init__(self, exit_code: int, stderr: str = '') -> None:
+        super().__init__(exit_code)
+        self.exit_code = exit_code
+        self.stderr = stderr
+
+
+TIME_LIMIT = 5
+
+
+class Interrupt:
+    """The time limit on solving a query, which can also be cut short from
+    another thread, along with a callback for each model that is found on
+    the way to the answer."""
+    def __init__(self, timeout: float = TIME_LIMIT,
+                 on_model: Optional[Callable[[List[clingo.Symbol]], None]]
+                 = None) -> None:
+        self.deadline = time.monotonic() + timeout
+        self.on_model = on_model
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.stops: List[Callable[[], None]] = []
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            for stop in self.stops:
+                stop()
+
+    @contextlib.contextmanager
+    def running(self, stop: Callable[[], None]) -> Iterator[None]:
+        with self.lock:
+            if self.cancelled:
+                raise ClingoError(ClingoExitCode.INTERRUPT)
+            self.stops.append(stop)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stops.remove(stop)
+
+
+interrupts: 'contextvars.ContextVar[Interrupt]' = \
+    contextvars.ContextVar('interrupts')
+
+
+def interrupt() -> Interrupt:
+    return interrupts.get(None) or Interrupt()
+
+
+# seconds spent on each stage of answering queries, and the size of the
+# programs and the effort of the searches that clingo reports, for profiling
+timings: Dict[str, float] = {
+    'translate': 0.0, 'assemble': 0.0, 'ground': 0.0, 'solve': 0.0}
+statistics: Dict[str, int] = {
+    'rules': 0, 'atoms': 0, 'choices': 0, 'conflicts': 0, 'models': 0,
+    'optimal': 0}
+# the costs of the last model that was optimised, at each priority, and the
+# bounds on them that the search proved
+optimization: Dict[str, List[int]] = {'costs': [], 'bounds': []}
+# held while they're added to, as queries can be solved in threads of their
+# own, by a Server's workers or by eval_async
+accounting = threading.Lock()
+
+
+@contextlib.contextmanager
+def timed(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with accounting:
+            timings[stage] += elapsed
+
+
+def print_costs(costs: List[int]) -> None:
+    if costs[0] < 0:
+        print(f"reward: {-costs[0]}.")
+    else:
+        print(f"cost: {costs[0]}.")
+
+
+Solution = Tuple[List[clingo.Symbol], List[int]]
+# command line options for clingo, e.g. ('--parallel-mode=4',)
+Options = Tuple[str, ...]
+
+# clingo's options for questions and for commands, set with e.g.
+#   #options ! --parallel-mode=8,compete --configuration=many.
+# questions are mostly settled by grounding, and are searched with the
+# configuration for large, structured problems. plans are searched with
+# the configuration for ASP programs, and optimised with clingo's default
+# strategy, as the planner weighs all its costs at one priority. both are
+# solved sequentially, as solvers running in parallel can settle on a
+# different one of several optimal plans from one run to the next
+OPTIONS: Dict[str, Options] = {
+    '?': ('--configuration=trendy',),
+    '!': ('--configuration=tweety',),
+}
+
+
+def run_clingo(lp: str, data: Data = (), options: Options = (),
+               timeout: Optional[float] = None) -> Solution:
+    current = interrupt()
+    if timeout is None:
+        timeout = current.remaining()
+    lp += ''.join(f'{sym}.\n' for sym in data)
+    try:
+        proc = sh.clingo(
+            *options, outf=2, stats=True,
+            time_limit=max(1, math.ceil(timeout)), _in=lp,
+            _err=sys.stderr if 'DEBUG' in os.environ else None,
+            _ok_code=[
+                ClingoExitCode.SAT,
+                ClingoExitCode.SAT | ClingoExitCode.EXHAUST
+            ], _bg=True, _bg_exc=False)
+        with current.running(lambda: proc.signal(signal.SIGINT)):
+            result = json.loads(proc.wait().stdout)
+    except sh.ErrorReturnCode as e:
+        raise ClingoError(e.exit_code, e.stderr.decode('utf-8'))
     if 'DEBUG' in os.environ:
         print(json.dumps(result, indent=2), file=sys.stderr)
+    stats = result['Stats']
+    with accounting:
+        timings['ground'] += \
+            result['Time']['Total'] - result['Time']['Solve']
+        timings['solve'] += result['Time']['Solve']
+        statistics['rules'] += stats['LP']['Rules']['Original']
+        statistics['atoms'] += stats['LP']['Atoms']
+        statistics['choices'] += stats['Core']['Choices']
+        statistics['conflicts'] += stats['Core']['Conflicts']
+        statistics['models'] += stats['More']['Models']
+        statistics['optimal'] += result['Models'].get('Optimal', 0)
+        if 'Costs' in result['Models']:
+            # the command line only tells of the bounds that are reached
+            optimization['costs'] = result['Models']['Costs']
+            optimization['bounds'] = result['Models']['Costs'] \
+                if result['Models'].get('Optimum') == 'yes' else []
     witness = result['Call'][-1]['Witnesses'][-1]
+    costs: List[int] = []
     if result['Result'] == 'OPTIMUM FOUND':
         costs = result['Models']['Costs']
         assert costs == witness['Costs']
-        if costs[0] < 0:
-            print(f"reward: {-costs[0]}.")
+    return [clingo.parse_term(atom) for atom in witness['Value']], costs
+
+
+def new_control(messages: List[str],
+                options: Options = ()) -> clingo.Control:
+    def logger(code: clingo.MessageCode, message: str) -> None:
+        messages.append(message)
+        if 'DEBUG' in os.environ:
+            print(message, file=sys.stderr)
+
+    return clingo.Control(list(options), logger=logger)
+
+
+def symbol(v: Any) -> clingo.Symbol:
+    if isinstance(v, int):
+        return clingo.Number(v)
+    elif isinstance(v, str):
+        return clingo.String(v)
+    elif isinstance(v, tuple):
+        return clingo.Tuple_([symbol(x) for x in v])
+    return cast(clingo.Symbol, v)
+
+
+# the functions defined by the Python scripts of the programs included so
+# far, for the contexts of in-process groundings to call. clingo runs the
+# scripts in its own namespace as well, which is what the clingo binary uses
+script: Dict[str, Any] = {}
+scripts: Set[str] = set()
+
+
+def run_scripts(path: str) -> None:
+    """Run the #script (python) blocks of a program into the namespace of
+    the contexts, once for each file. A file that can't be read is left for
+    clingo to report when it includes it."""
+    if path in scripts:
+        return
+    try:
+        with open(path) as f:
+            text = f.read()
+    except OSError:
+        return
+    scripts.add(path)
+    for code in re.findall(r'^#script \(python\)$(.*?)^#end\.', text,
+                           re.M | re.S):
+        exec(code, script)
+
+
+class Context:
+    """The values gathered for @setof and @bagof while grounding one
+    program, kept sorted as they arrive, and dropped along with the context
+    once it has been grounded.
+
+    Other functions are looked up among those of the included scripts (see
+    run_scripts), and the errors they raise are added to the messages of
+    the solver.
+    """
+    def __init__(self, messages: Optional[List[str]] = None) -> None:
+        self.messages = [] if messages is None else messages
+        self.members: Dict[clingo.Symbol, Set[clingo.Symbol]] = {}
+        self.sets: Dict[clingo.Symbol, List[clingo.Symbol]] = {}
+        self.bags: Dict[clingo.Symbol, Optional[List[clingo.Symbol]]] = {}
+        self.symbols: Dict[Tuple[str, clingo.Symbol], clingo.Symbol] = {}
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        if name not in script:
+            raise AttributeError(name)
+        fun = script[name]
+
+        def call(*args: clingo.Symbol) -> Any:
+            # functions called from a context must return symbols, where
+            # those called from a script may return Python values; errors
+            # are logged, as the clingo binary logs those of a script, and
+            # fail the grounding like any other
+            try:
+                ret = fun(*args)
+            except Exception as e:
+                self.messages.append(f'@{name}: {e!r}')
+                raise RuntimeError(self.messages[-1])
+            if isinstance(ret, list):
+                return [symbol(v) for v in ret]
+            return symbol(ret)
+
+        setattr(self, name, call)
+        return call
+
+    def gather(self, i: clingo.Symbol, a: clingo.Symbol) -> clingo.Symbol:
+        if i not in self.members:
+            self.members[i] = set()
+            self.sets[i] = []
+            self.bags[i] = []
+        if a.match('gather_sentinel', 0) or a in self.members[i]:
+            return i
+        self.members[i].add(a)
+        bisect.insort(self.sets[i], a)
+        bag = self.bags[i]
+        if bag is not None and a.type == clingo.SymbolType.Function \
+                and a.arguments:
+            bisect.insort(bag, a.arguments[0])
+        else:
+            self.bags[i] = None
+        self.symbols.pop(('set', i), None)
+        self.symbols.pop(('bag', i), None)
+        return i
+
+    def setof(self, i: clingo.Symbol) -> clingo.Symbol:
+        if i not in self.sets:
+            return clingo.Function('empty')
+        if ('set', i) not in self.symbols:
+            self.symbols['set', i] = clingo.Function('set', self.sets[i])
+        return self.symbols['set', i]
+
+    def bagof(self, i: clingo.Symbol) -> clingo.Symbol:
+        bag = self.bags.get(i)
+        if bag is None:
+            return clingo.Function('error')
+        if ('bag', i) not in self.symbols:
+            self.symbols['bag', i] = clingo.Function('bag', bag)
+        return self.symbols['bag', i]
+
+
+statements: Dict[str, List[clingo.ast.AST]] = {}
+
+
+def parse_lines(lines: Iterable[str]) -> Dict[str, List[clingo.ast.AST]]:
+    """The statements of each of some lines, which are parsed together."""
+    new = list(dict.fromkeys(lines))
+    parsed: Dict[str, List[clingo.ast.AST]] = {}
+    for line in new:
+        parsed[line] = []
+        if line.startswith('#include'):
+            # the statements of an included file can't be told apart
+            # from those of the lines around it
+            clingo.ast.parse_string(line, parsed[line].append,
+                                    logger=lambda code, msg: None)
+            del parsed[line][0]
+    batch = [line for line in new if not line.startswith('#include')]
+    stms: List[clingo.ast.AST] = []
+    clingo.ast.parse_string('\n'.join(batch), stms.append,
+                            logger=lambda code, msg: None)
+    filled = [line for line in batch
+              if line.strip() and not line.startswith('%')]
+    if len(stms) - 1 == len(filled):
+        # looking up locations is slow, so they are only used when
+        # some line doesn't hold exactly one statement
+        for line, stm in zip(filled, stms[1:]):
+            parsed[line].append(stm)
+    else:
+        for stm in stms[1:]:
+            parsed[batch[stm.location.begin.line - 1]].append(stm)
+    return parsed
+
+
+def add_program(ctl: clingo.Control, lp: str) -> None:
+    """Add a program to the base part through its syntax tree.
+
+    Programs have one statement per line, and are mostly made of the lines
+    of the previous program, so only the lines that weren't seen before are
+    parsed, and the statements of a line are kept for as long as it stays in
+    use.
+    """
+    global statements
+    lines = lp.split('\n')
+    # programs added in other threads replace the statements that are kept
+    # as a whole, so this looks them up in the ones it starts with
+    known = statements
+    parsed = {line: known[line] for line in lines if line in known}
+    try:
+        parsed.update(parse_lines(line for line in lines
+                                  if line not in parsed))
+    except RuntimeError:
+        # the text is parsed as a whole, with the error messages that go
+        # with it if it is wrong
+        ctl.add('base', [], lp)
+        return
+    with clingo.ast.ProgramBuilder(ctl) as builder:
+        for line in lines:
+            for stm in parsed[line]:
+                builder.add(stm)
+    statements = parsed
+
+
+def add_data(ctl: clingo.Control, data: Data) -> None:
+    with ctl.backend() as backend:
+        for sym in data:
+            backend.add_rule([backend.add_atom(sym)])
+
+
+def solve_control(ctl: clingo.Control, messages: List[str],
+                  timeout: Optional[float] = None) -> Solution:
+    current = interrupt()
+    if timeout is None:
+        timeout = current.remaining()
+    witness: List[clingo.Symbol] = []
+    costs: List[int] = []
+
+    def on_model(model: clingo.Model) -> None:
+        witness[:] = model.symbols(shown=True)
+        costs[:] = model.cost
+        if 'DEBUG' in os.environ:
+            print('Answer:', ' '.join(map(str, witness)), file=sys.stderr)
+        if current.on_model is not None:
+            current.on_model(list(witness))
+
+    try:
+        with ctl.solve(on_model=on_model, async_=True) as handle, \
+                current.running(ctl.interrupt), timed('solve'):
+            if not handle.wait(timeout):
+                handle.cancel()
+            result = handle.get()
+    except RuntimeError:
+        raise ClingoError(ClingoExitCode.ERROR, '\n'.join(messages))
+    stats = ctl.statistics
+    with accounting:
+        statistics['rules'] += int(stats['problem']['lp']['rules'])
+        statistics['atoms'] += int(stats['problem']['lp']['atoms'])
+        statistics['choices'] += int(stats['solving']['solvers']['choices'])
+        statistics['conflicts'] += \
+            int(stats['solving']['solvers']['conflicts'])
+        statistics['models'] += \
+            int(stats['summary']['models']['enumerated'])
+        statistics['optimal'] += int(stats['summary']['models']['optimal'])
+        summary = stats['summary']
+        if 'costs' in summary and all(map(math.isfinite, summary['costs'])):
+            # bounds that haven't been proven are infinite
+            lower = summary.get('lower', [])
+            optimization['costs'] = [int(c) for c in summary['costs']]
+            optimization['bounds'] = [int(b) for b in lower] \
+                if all(map(math.isfinite, lower)) else []
+    exit_code = ClingoExitCode.UNKNOWN
+    if result.satisfiable:
+        exit_code |= ClingoExitCode.SAT
+    if result.exhausted:
+        exit_code |= ClingoExitCode.EXHAUST
+    if result.interrupted:
+        exit_code |= ClingoExitCode.INTERRUPT
+    if exit_code not in (ClingoExitCode.SAT,
+                         ClingoExitCode.SAT | ClingoExitCode.EXHAUST):
+        raise ClingoError(exit_code, '\n'.join(messages))
+    if not result.exhausted:
+        costs = []
+    return witness, costs
+
+
+def run_control(lp: str, data: Data = (), options: Options = ()) -> Solution:
+    messages: List[str] = []
+    ctl = new_control(messages, options)
+    try:
+        with timed('ground'):
+            add_program(ctl, lp)
+            add_data(ctl, data)
+            ctl.ground([('base', [])], context=Context(messages))
+    except RuntimeError:
+        raise ClingoError(ClingoExitCode.ERROR, '\n'.join(messages))
+    return solve_control(ctl, messages)
+
+
+class Observer(clingo.backend.Observer):
+    """Counts the ground rules with each atom in their head, as they are
+    passed to the solver; integrity constraints are counted against 0."""
+    def __init__(self) -> None:
+        self.rules: Dict[int, int] = {}
+
+    def rule(self, choice: bool, head: Sequence[int],
+             body: Sequence[int]) -> None:
+        for atom in head or [0]:
+            self.rules[atom] = self.rules.get(atom, 0) + 1
+
+    def weight_rule(self, choice: bool, head: Sequence[int],
+                    lower_bound: int,
+                    body: Sequence[Tuple[int, int]]) -> None:
+        self.rule(choice, head, [])
+
+
+class Names(clingo.ast.Transformer):
+    """Collects the names of the variables, and the signatures of the
+    predicates, that appear in a part of a statement, and whether it has
+    anonymous variables or calls any functions."""
+    def __init__(self) -> None:
+        self.variables: List[str] = []
+        self.predicates: Set[str] = set()
+        self.anonymous = False
+        self.calls = False
+
+    def visit_Variable(self, node: clingo.ast.AST) -> clingo.ast.AST:
+        if node.name == '_':
+            self.anonymous = True
+        elif node.name not in self.variables:
+            self.variables.append(node.name)
+        return node
+
+    def visit_Function(self, node: clingo.ast.AST) -> clingo.ast.AST:
+        self.calls = self.calls or node.external
+        return node.update(**self.visit_children(node))
+
+    def visit_SymbolicAtom(self, node: clingo.ast.AST) -> clingo.ast.AST:
+        if node.symbol.ast_type == clingo.ast.ASTType.Function:
+            self.predicates.add(signature(node.symbol))
+        return node.update(**self.visit_children(node))
+
+
+def signature(atom: clingo.ast.AST) -> str:
+    return f'{atom.name}/{len(atom.arguments)}'
+
+
+def names(ast: clingo.ast.AST) -> Names:
+    found = Names()
+    found(ast)
+    return found
+
+
+def mark(stm: clingo.ast.AST, i: int) -> clingo.ast.AST:
+    """A rule that derives __origin(i, ...) from the body of a statement,
+    along with the variables that its body binds, so that there is one such
+    atom for each ground instance of the statement."""
+    ASTType = clingo.ast.ASTType
+    variables = Names()
+    for lit in stm.body:
+        if lit.ast_type != ASTType.Literal:
+            continue  # the variables of a condition are local to it
+        if lit.atom.ast_type in (ASTType.SymbolicAtom, ASTType.Comparison):
+            variables(lit.atom)
+        elif lit.atom.ast_type in (ASTType.Aggregate, ASTType.BodyAggregate):
+            for guard in (lit.atom.left_guard, lit.atom.right_guard):
+                if guard is not None:
+                    variables(guard.term)
+    loc = stm.location
+    head = clingo.ast.Function(
+        loc, '__origin', [clingo.ast.SymbolicTerm(loc, clingo.Number(i))] +
+        [clingo.ast.Variable(loc, name) for name in variables.variables],
+        False)
+    return clingo.ast.Rule(loc, clingo.ast.Literal(
+        loc, clingo.ast.Sign.NoSign, clingo.ast.SymbolicAtom(head)),
+        stm.body)
+
+
+def profile_control(lp: str, sources: List[str],
+                    data: Data = ()) -> Dict[str, Any]:
+    """Ground a program, counting the ground rules and atoms that come of
+    each of its sources and that belong to each predicate, most first.
+
+    The source of each line of the program is given, and that of a line
+    of an included file is its name and line number. The rules of a source
+    are counted by grounding their bodies a second time, and its atoms are
+    those of the predicates that its rules define.
+    """
+    messages: List[str] = []
+    ctl = new_control(messages)
+    observer = Observer()
+    ctl.register_observer(observer)
+    origins: List[str] = []
+    defines: Dict[str, Set[str]] = {}
+
+    def add(stm: clingo.ast.AST) -> None:
+        if stm.ast_type in (clingo.ast.ASTType.Rule,
+                            clingo.ast.ASTType.Minimize):
+            begin = stm.location.begin
+            origin = sources[begin.line - 1] \
+                if begin.filename == '<string>' \
+                else f'{begin.filename}:{begin.line}'
+            defines.setdefault(origin, set())
+            if stm.ast_type == clingo.ast.ASTType.Rule:
+                defines[origin] |= names(stm.head).predicates
+            origins.append(origin)
+            builder.add(mark(stm, len(origins) - 1))
+        builder.add(stm)
+
+    try:
+        with clingo.ast.ProgramBuilder(ctl) as builder:
+            clingo.ast.parse_string(lp, add, logger=lambda code, msg: None)
+        add_data(ctl, data)
+        ctl.ground([('base', [])], context=Context(messages))
+    except RuntimeError:
+        raise ClingoError(ClingoExitCode.ERROR, '\n'.join(messages))
+
+    predicates = {0: '#false'}
+    atoms: Dict[str, int] = {}
+    instances: Dict[str, int] = {}
+    for atom in ctl.symbolic_atoms:
+        name, args = atom.symbol.name, atom.symbol.arguments
+        if name == '__origin':
+            origin = origins[args[0].number]
+            instances[origin] = instances.get(origin, 0) + 1
+            predicates[atom.literal] = ''
+            continue
+        signature = f'{name}/{len(args)}'
+        predicates[atom.literal] = signature
+        atoms[signature] = atoms.get(signature, 0) + 1
+    rules: Dict[str, int] = {}
+    for literal, n in observer.rules.items():
+        # atoms that aren't symbolic are introduced by the grounder, for
+        # aggregates and the like
+        signature = predicates.get(literal, '#aux')
+        if signature:
+            rules[signature] = rules.get(signature, 0) + n
+    return {
+        'sentences': sorted(({
+            'source': origin,
+            'rules': instances.get(origin, 0),
+            'atoms': sum(n for signature, n in atoms.items()
+                         if signature in defined),
+        } for origin, defined in defines.items()),
+            key=lambda row: (-row['rules'], -row['atoms'], row['source'])),
+        'predicates': sorted(({
+            'predicate': signature,
+            'rules': rules.get(signature, 0),
+            'atoms': atoms.get(signature, 0),
+        } for signature in set(rules) | set(atoms)),
+            key=lambda row: (-row['rules'], -row['atoms'], row['predicate'])),
+    }
+
+
+def atom(lit: clingo.ast.AST) -> Optional[clingo.ast.AST]:
+    """The atom of a literal that is a plain positive atom."""
+    if lit.ast_type == clingo.ast.ASTType.Literal and \
+            lit.sign == clingo.ast.Sign.NoSign and \
+            lit.atom.ast_type == clingo.ast.ASTType.SymbolicAtom and \
+            lit.atom.symbol.ast_type == clingo.ast.ASTType.Function:
+        return cast(clingo.ast.AST, lit.atom.symbol)
+    return None
+
+
+def pattern(term: clingo.ast.AST) -> bool:
+    """Whether a term can be matched against, binding its variables."""
+    if term.ast_type == clingo.ast.ASTType.Function:
+        return not term.external and all(map(pattern, term.arguments))
+    return term.ast_type in (clingo.ast.ASTType.Variable,
+                             clingo.ast.ASTType.SymbolicTerm)
+
+
+def known(terms: Sequence[clingo.ast.AST], bound: Set[str]) -> bool:
+    found = Names()
+    for term in terms:
+        found(term)
+    return not found.anonymous and set(found.variables) <= bound
+
+
+def seed(atom: clingo.ast.AST) -> clingo.ast.AST:
+    """The literal that asks for an atom p(V,X...), given X..."""
+    loc = atom.location
+    return clingo.ast.Literal(loc, clingo.ast.Sign.NoSign,
+                              clingo.ast.SymbolicAtom(clingo.ast.Function(
+                                  loc, f'__magic_{atom.name}',
+                                  atom.arguments[1:], False)))
+
+
+def demands(rule: clingo.ast.AST, rewritten: Set[str],
+            unbound: Set[str]) -> List[clingo.ast.AST]:
+    """The rules that ask for the atoms of rewritten predicates in the body
+    of a rule, given the part of the body that is known before each of them,
+    noting the predicates whose arguments can't be known."""
+    ASTType = clingo.ast.ASTType
+    head = atom(rule.head)
+    body: List[clingo.ast.AST] = []
+    bound: Set[str] = set()
+    if head is not None and signature(head) in rewritten:
+        body.append(seed(head))
+        bound |= set(names(body[0]).variables)
+    pending = [lit for lit in rule.body if lit.ast_type == ASTType.Literal]
+    rules: List[clingo.ast.AST] = []
+    progress = True
+    while progress:
+        progress = False
+        for lit in list(pending):
+            found = atom(lit)
+            if found is not None and signature(found) in rewritten:
+                if not known(found.arguments[1:], bound):
+                    continue
+                rules.append(clingo.ast.Rule(
+                    rule.location, seed(found), list(body)))
+            elif found is not None:
+                if not all(pattern(arg) or known([arg], bound)
+                           for arg in found.arguments):
+                    continue
+            elif lit.sign == clingo.ast.Sign.NoSign and \
+                    lit.atom.ast_type == ASTType.Comparison and \
+                    not names(lit.atom).calls:
+                left, guards = lit.atom.term, lit.atom.guards
+                if not known([lit.atom], bound) and not (
+                        len(guards) == 1 and guards[0].comparison ==
+                        clingo.ast.ComparisonOperator.Equal and any(
+                            x.ast_type == ASTType.Variable and
+                            known([y], bound) for x, y in
+                            [(left, guards[0].term), (guards[0].term, left)])):
+                    continue
+            else:
+                # negations, aggregates and calls are left out, which only
+                # asks for more than is needed
+                pending.remove(lit)
+                continue
+            body.append(lit)
+            bound |= set(names(lit).variables)
+            pending.remove(lit)
+            progress = True
+    for lit in pending:
+        found = atom(lit)
+        if found is not None and signature(found) in rewritten:
+            unbound.add(signature(found))
+    return rules
+
+
+class Uses:
+    """How a statement uses predicates, and which atoms of them its rule
+    asks for, once some of them have been rewritten by magic_sets."""
+    def __init__(self, stm: clingo.ast.AST) -> None:
+        ASTType = clingo.ast.ASTType
+        self.stm = stm
+        self.head: Optional[clingo.ast.AST] = None
+        # the predicates it defines, those it uses as positive atoms of
+        # its body, and those it uses otherwise, which can't be rewritten
+        self.defined: Set[str] = set()
+        self.positive: Set[str] = set()
+        self.other: Set[str] = set()
+        self.chosen = False
+        self.candidate = False
+        self.demands: Dict[FrozenSet[str],
+                           Tuple[List[clingo.ast.AST], Set[str]]] = {}
+        if stm.ast_type == ASTType.ShowSignature:
+            self.other.add(f'{stm.name}/{stm.arity}')
+            return
+        if stm.ast_type != ASTType.Rule:
+            self.other = names(stm).predicates
+            return
+        self.head = atom(stm.head)
+        if self.head is None:
+            self.defined = self.other = names(stm.head).predicates
+            self.chosen = bool(self.defined)
         else:
-            print(f"cost: {costs[0]}.")
-    return cast(List[str], witness['Value'])
+            self.defined = {signature(self.head)}
+            self.candidate = len(self.head.arguments) > 1 and all(
+                arg.ast_type in (ASTType.Variable, ASTType.SymbolicTerm)
+                for arg in self.head.arguments[1:])
+        for lit in stm.body:
+            found = atom(lit)
+            if found is not None:
+                self.positive.add(signature(found))
+            else:
+                self.other = self.other | names(lit).predicates
+
+    def ask(self, rewritten: Set[str]
+            ) -> Tuple[List[clingo.ast.AST], Set[str]]:
+        key = frozenset((self.positive | self.defined) & rewritten)
+        if key not in self.demands:
+            unbound: Set[str] = set()
+            self.demands[key] = demands(self.stm, rewritten, unbound), unbound
+        return self.demands[key]
+
+
+# the uses of the statements of the lines of the last program rewritten
+uses: Dict[str, List[Uses]] = {}
+
+
+def magic_sets(lp: str) -> str:
+    """Rewrite a program so that only the atoms of its functions that are
+    asked for, directly or through other functions, are grounded.
+
+    A predicate p(V,X...) is rewritten when it is only ever used as a
+    positive atom, so that its arguments X... are known from the rest of
+    the rule that uses it, and when it doesn't depend on choices or on
+    itself through negation or aggregates. Its rules then only apply to
+    the arguments in __magic_p(X...), which each use of p adds to, from
+    the part of the rule that is known before it.
+
+    Like add_program, only the lines that weren't in the last program are
+    parsed.
+    """
+    global uses
+    lines = lp.split('\n')
+    parsed = {line: uses[line] for line in lines if line in uses}
+    try:
+        parsed.update({line: [Uses(stm) for stm in stms]
+                       for line, stms in parse_lines(
+                           line for line in lines
+                           if line not in parsed).items()})
+    except RuntimeError:
+        return lp  # the error is left for the solver to report
+    uses = parsed
+    stms = [stm for line in dict.fromkeys(lines) for stm in parsed[line]]
+
+    opaque: Set[str] = set()
+    chosen: Set[str] = set()
+    candidates: Set[str] = set()
+    depends: Dict[str, Set[str]] = {}
+    negative: Dict[str, Set[str]] = {}
+    for stm in stms:
+        opaque |= stm.other
+        if stm.chosen:
+            chosen |= stm.defined
+        elif stm.candidate:
+            candidates |= stm.defined
+        else:
+            opaque |= stm.defined
+        for name in stm.defined:
+            depends.setdefault(name, set()).update(stm.positive | stm.other)
+            negative.setdefault(name, set()).update(stm.other)
+
+    reached: Dict[str, Set[str]] = {}
+
+    def reach(name: str) -> Set[str]:
+        if name not in reached:
+            seen, stack = {name}, [name]
+            while stack:
+                for used in depends.get(stack.pop(), set()) - seen:
+                    seen.add(used)
+                    stack.append(used)
+            reached[name] = seen
+        return reached[name]
+
+    rewritten = {name for name in candidates - opaque
+                 if not reach(name) & chosen and not any(
+                     name in reach(used) for below in reach(name)
+                     for used in negative.get(below, set()))}
+    magic: List[clingo.ast.AST] = []
+    while rewritten:
+        unbound: Set[str] = set()
+        magic = []
+        for stm in stms:
+            if stm.positive & rewritten:
+                rules, missing = stm.ask(rewritten)
+                magic += rules
+                unbound |= missing
+        if not unbound:
+            break
+        rewritten -= unbound
+    if not rewritten:
+        return lp
+
+    # rules are guarded where they are the only statement on their line,
+    # and are otherwise left to apply to every argument
+    for i, line in enumerate(lines):
+        if len(parsed[line]) == 1:
+            stm = parsed[line][0]
+            if stm.head is not None and stm.stm.body and \
+                    signature(stm.head) in rewritten:
+                lines[i] = str(stm.stm.update(
+                    body=[seed(stm.head)] + list(stm.stm.body)))
+    return '\n'.join(lines) + ''.join(f'{rule}\n' for rule in magic)
+
+
+def guard(rule: str, atom: str) -> str:
+    if rule.startswith(':- '):
+        return f':- {atom}, {rule[3:]}'
+    elif ' :- ' in rule:
+        head, body = rule.split(' :- ', 1)
+        return f'{head} :- {atom}, {body}'
+    else:
+        return f'{rule[:-1]} :- {atom}.'
+
+
+def dependents(program: str, names: Set[str]) -> Set[str]:
+    uses: Dict[str, Set[str]] = {}
+    for rule in program.split('\n'):
+        if ' :- ' in rule:
+            head, body = rule.split(' :- ', 1)
+            for name in re.findall(r'\b([a-z]\w*)\(', body):
+                uses.setdefault(name, set()).add(head.split('(', 1)[0])
+    todo = list(names)
+    while todo:
+        for name in uses.get(todo.pop(), ()):
+            if name not in names:
+                names.add(name)
+                todo.append(name)
+    return names
+
+
+# the queries that a session answers before it grounds its program afresh
+SESSION_QUERIES = 100
+
+
+class Session:
+    """Multi-shot solving of queries against a program that is only
+    grounded once, until it changes.
+
+    Each query is added as its own program part, with its rules guarded by
+    an external atom that is released once the query has been answered,
+    and its answers derived under predicates of its own. Released parts
+    still take up room in the solver, so the program is grounded afresh
+    after SESSION_QUERIES queries.
+    Queries that depend on state which changes between queries (the history
+    of previous answers) or that need the prelude's aggregation rules to be
+    grounded again are left to a fresh solver.
+    """
+    def __init__(self) -> None:
+        self.ctl: Optional[clingo.Control] = None
+        self.key: Optional[
+            Tuple[int, FrozenSet[str], str, Data, Options]] = None
+        self.messages: List[str] = []
+        self.stateful: Set[str] = set()
+        self.queries = 0
+
+    def ground(self, now: int, facts: FrozenSet[str], program: str,
+               data: Data, options: Options) -> None:
+        self.ctl = None
+        self.messages = []
+        ctl = new_control(self.messages, options)
+        lp = f'#const now = {now}.\n'
+        lp += '#const counter = 0.\n'
+        lp += ''.join(fact + '.\n' for fact in facts)
+        lp += program
+        try:
+            with timed('ground'):
+                add_program(ctl, lp)
+                add_data(ctl, data)
+                ctl.ground([('base', [])], context=Context(self.messages))
+        except RuntimeError:
+            raise ClingoError(ClingoExitCode.ERROR, '\n'.join(self.messages))
+        self.ctl = ctl
+        self.queries = 0
+        self.key = now, facts, program, data, options
+        self.stateful = dependents(program, set(['history', 'that']))
+
+    def solve(self, parent: 'ASPI', lp: str,
+              program: str) -> Optional[Solution]:
+        facts = frozenset(fact for fact in parent.facts
+                          if not re.match(r'history\(\d+,what\(', fact))
+        key = parent.now, facts, program, parent.data, parent.options['?']
+        if self.key != key or self.queries >= SESSION_QUERIES:
+            self.ground(*key)
+        rules = [rule for rule in lp.split('\n')
+                 if rule and not rule.startswith('proof(')]
+        names = set(name for rule in rules
+                    for name in re.findall(r'\b([a-z]\w*)\(', rule))
+        if 'gather' in names or self.stateful & names:
+            return None
+        assert self.ctl is not None
+        self.queries += 1
+        n = self.queries
+        query = f'query({n})'
+        # atoms defined by an earlier part can't be redefined, so answers
+        # get a predicate of their own and are shown under the usual names
+        part = f'#external {query}.\n'
+        part += f'#show what(X) : what_{n}(X).\n'
+        part += f'#show history({parent.counter},what(X)) : what_{n}(X).\n'
+        part += f'#show yes : yes_{n}.\n'
+        part += f'#show no : no_{n}.\n'
+        for rule in rules:
+            if rule == 'no :- not yes.':
+                rule = f'no_{n} :- not yes_{n}.'
+            rule = re.sub(r'^(what|yes)\b', rf'\1_{n}', rule)
+            part += guard(rule, query) + '\n'
+        try:
+            with timed('ground'):
+                self.ctl.add(f'query_{self.queries}', [], part)
+                self.ctl.ground([(f'query_{self.queries}', [])],
+                                context=Context(self.messages))
+        except RuntimeError:
+            self.key = None
+            raise ClingoError(ClingoExitCode.ERROR, '\n'.join(self.messages))
+        external = clingo.parse_term(query)
+        self.ctl.assign_external(external, True)
+        try:
+            return solve_control(self.ctl, self.messages)
+        finally:
+            self.ctl.release_external(external)
+
+
+CacheKey = Tuple[str, str, FrozenSet[str], int]
+# a translated question or command: its program, cache key, counter, and
+# how to solve it
+Query = Tuple[str, Optional[CacheKey], int, Callable[[], Solution]]
+
+
+def restamp(witness: List[clingo.Symbol], stamp: int,
+            counter: int) -> List[clingo.Symbol]:
+    """Move the answers recorded in the history of a solution from the
+    question they were solved for to the current one."""
+    if stamp == counter:
+        return witness
+    return [clingo.Function('history', [clingo.Number(counter),
+                                        atom.arguments[1]])
+            if atom.match('history', 2) and
+            atom.arguments[0] == clingo.Number(stamp) else atom
+            for atom in witness]
+
+
+def renumber(lp: str, program: str) -> str:
+    """Number the closures and proof variables of a translation from 1,
+    to key it by.
+
+    The translator numbers them on from the last sentence it translated,
+    so the same question asked again is translated with new numbers. A
+    closure that the program defines keeps its number, and the others are
+    numbered #1, #2, ..., which no program can use.
+    """
+    numbers: Dict[str, str] = {}
+
+    def closure(m: re.Match[str]) -> str:
+        name, i = m.groups()
+        if re.search(rf'\b{name}\(\({i}\b', program):
+            return m.group(0)
+        if m.group(0) not in numbers:
+            n = sum(key.startswith(f'{name}((') for key in numbers) + 1
+            numbers[m.group(0)] = f'{name}((#{n}'
+        return numbers[m.group(0)]
+
+    def proof(m: re.Match[str]) -> str:
+        if m.group(0) not in numbers:
+            n = sum(key.startswith('P') for key in numbers) + 1
+            numbers[m.group(0)] = f'P{n}'
+        return numbers[m.group(0)]
+
+    lp = re.sub(r'\b([a-z]\w*)\(\((\d+)\b', closure, lp)
+    return re.sub(r'\bP\d+\b', proof, lp)
+
+
+class QueryCache:
+    """Solutions to questions, kept for as long as the program, facts and
+    time they were solved against stay the same, and evicted least
+    recently used first.
+
+    The answers recorded in the history are stamped with the counter of
+    the question that is being answered, so questions that depend on the
+    history aren't cached.
+    """
+    def __init__(self, size: int = 256) -> None:
+        self.size = size
+        self.entries: Dict[CacheKey, Tuple[Solution, int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.program: Optional[str] = None
+        self.stateful: Set[str] = set()
+
+    def key(self, parent: 'ASPI', lp: str,
+            program: str) -> Optional[CacheKey]:
+        if self.size <= 0:
+            return None
+        if program != self.program:
+            self.program = program
+            self.stateful = dependents(program, set(['history', 'that']))
+        if self.stateful & set(re.findall(r'\b([a-z]\w*)\(', lp)):
+            return None
+        facts = frozenset(fact for fact in parent.facts
+                          if not re.match(r'history\(\d+,what\(', fact))
+        return renumber(lp, program), program, facts, parent.now
+
+    def get(self, key: CacheKey, counter: int) -> Optional[Solution]:
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        (witness, costs), stamp = self.entries.pop(key)
+        self.entries[key] = (witness, costs), stamp
+        return restamp(witness, stamp, counter), costs
+
+    def put(self, key: CacheKey, solution: Solution, counter: int) -> None:
+        self.entries[key] = solution, counter
+        while len(self.entries) > self.size:
+            del self.entries[next(iter(self.entries))]
+
+    def clear(self) -> None:
+        self.entries = {}
+
+
+def setting(cmd: str, least: int, usage: str = 'N') -> Optional[int]:
+    """The number that a directive like `#page 10.` sets, or None, once
+    how to use the directive is printed, unless that is a whole number of
+    at least `least`."""
+    name, _, arg = cmd[:-1].partition(' ')
+    if re.fullmatch(r'\d+', arg) and int(arg) >= least:
+        return int(arg)
+    print(f'usage: {name} {usage}., with N >= {least}', file=sys.stderr)
+    return None
+
+
+def definite(rule: str) -> bool:
+    """Whether a rule only derives an atom, so that it can share a model
+    with the rules of other questions."""
+    head = rule.split(' :- ', 1)[0]
+    return re.match(r'[a-z]', head) is not None and \
+        re.search(r'[;|{]', head) is None
+
+
+def tag(rule: str, i: int) -> str:
+    """Give the answers derived by a rule of a question the number of the
+    question, when questions are solved together."""
+    if rule == 'no :- not yes.':
+        return f'no({i}) :- not yes({i}).'
+    rule = re.sub(r'^what\(', f'what({i},', rule)
+    return re.sub(r'^yes\b', f'yes({i})', rule)
+
+
+solvers: Dict[str, Callable[[str, Data, Options], Solution]] = {
+    'clingo': run_clingo,
+    'control': run_control,
+}
+
+
+# plans with costs are optimised over at least this many steps, as they
+# were when it was as far as plans could go
+HORIZON = 20
+
+
+def deepen(now: int,
+           solve: Callable[[int, float], Optional[Solution]]) -> Solution:
+    """Look for a plan one step further at a time, until there is one.
+
+    Plans of any length up to a horizon are looked for at once, so when
+    costs are present, the cheapest plan is then looked for within a
+    horizon of at least HORIZON steps, as a longer plan can be cheaper.
+
+    `solve` returns None when there is no plan within the given horizon.
+    """
+    deadline = interrupt().deadline
+    best: Optional[Solution] = None
+    horizon = now
+    while True:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            if best is not None:
+                return best
+            raise ClingoError(ClingoExitCode.INTERRUPT)
+        try:
+            solution = solve(horizon, timeout)
+        except ClingoError as e:
+            if best is not None and e.exit_code == ClingoExitCode.INTERRUPT:
+                return best
+            raise
+        if solution is not None:
+            witness, costs = solution
+            if not costs or best is not None:
+                return solution
+            best = solution
+            if horizon >= now + HORIZON:
+                return best
+            horizon = now + HORIZON
+        else:
+            horizon += 1
+
+
+def unreachable(ctl: clingo.Control, tmax: int) -> bool:
+    """Whether a goal of a planning problem, grounded up to tmax, can't
+    succeed at any horizon: once the fluents that might hold stop changing
+    from one step to the next, a goal that can't succeed by then never
+    will."""
+    atoms = ctl.symbolic_atoms
+    fluents: Dict[int, Set[clingo.Symbol]] = {}
+    for atom in atoms.by_signature('holds', 2):
+        fluent, t = atom.symbol.arguments
+        fluents.setdefault(t.number, set()).add(fluent)
+    if fluents.get(tmax) != fluents.get(tmax - 1):
+        return False
+    succeeded = set(atom.symbol.arguments[0]
+                    for atom in atoms.by_signature('success', 2))
+    return any(atom.is_fact and atom.symbol.arguments[0] not in succeeded
+               for atom in atoms.by_signature('goal', 1))
+
+
+def horizon_program(horizon: int) -> str:
+    # ground a step beyond the horizon, as a Planner would, so that the
+    # costs of plans are optimised even at the current time
+    return f'#const tmax = {horizon + 1}.\nhorizon({horizon}).\n'
+
+
+def plan_clingo(lp: str, now: int, data: Data = (),
+                options: Options = ()) -> Solution:
+    def solve(horizon: int, timeout: float) -> Optional[Solution]:
+        try:
+            return run_clingo(lp + horizon_program(horizon), data, options,
+                              timeout)
+        except ClingoError as e:
+            if e.exit_code != ClingoExitCode.EXHAUST:
+                raise
+            # the grounding is looked at where a Planner would ground it
+            # again, once the horizon has doubled
+            steps = horizon - now
+            if steps & (steps - 1) == 0 and unground(horizon + 1):
+                raise
+            return None
+
+    def unground(tmax: int) -> bool:
+        messages: List[str] = []
+        ctl = new_control(messages)
+        try:
+            with timed('ground'):
+                add_program(ctl, lp + f'#const tmax = {tmax}.\n')
+                add_data(ctl, data)
+                ctl.ground([('base', [])], context=Context(messages))
+        except RuntimeError:
+            raise ClingoError(ClingoExitCode.ERROR, '\n'.join(messages))
+        return unreachable(ctl, tmax)
+
+    return deepen(now, solve)
+
+
+class Planner:
+    """Grounds the time steps of a planning problem in chunks of doubling
+    size, each of which is shared by all the horizons within it. A horizon
+    is selected by assigning its external atom.
+
+    A horizon that doesn't follow the last one, such as the one that the
+    cheapest plan is looked for within, is solved on a grounding of its
+    own, so that which of several optimal plans is found doesn't depend
+    on the horizons that were tried before it.
+    """
+    def __init__(self, lp: str, now: int, data: Data = (),
+                 options: Options = ()) -> None:
+        self.lp = lp
+        self.data = data
+        self.options = options
+        self.now = now
+        self.tmax = now
+        self.horizon = now
+        self.ctl: Optional[clingo.Control] = None
+        self.messages: List[str] = []
+
+    def ground(self) -> None:
+        self.tmax = self.now + max(1, 2 * (self.tmax - self.now))
+        self.messages = []
+        self.ctl = new_control(self.messages, self.options)
+        try:
+            with timed('ground'):
+                add_program(self.ctl,
+                            self.lp + f'#const tmax = {self.tmax}.\n')
+                add_data(self.ctl, self.data)
+                self.ctl.ground([('base', [])],
+                                context=Context(self.messages))
+        except RuntimeError:
+            raise ClingoError(ClingoExitCode.ERROR, '\n'.join(self.messages))
+
+    def solve(self, horizon: int, timeout: float) -> Optional[Solution]:
+        if horizon > self.horizon + 1:
+            self.ctl = None
+            self.tmax = self.now
+        self.horizon = horizon
+        while self.ctl is None or horizon > self.tmax:
+            self.ground()
+        assert self.ctl is not None
+        for t in range(self.now, self.tmax + 1):
+            atom = clingo.Function('horizon', [clingo.Number(t)])
+            self.ctl.assign_external(atom, t == horizon)
+        try:
+            return solve_control(self.ctl, self.messages, timeout)
+        except ClingoError as e:
+            if e.exit_code != ClingoExitCode.EXHAUST:
+                raise
+            if horizon == self.tmax and unreachable(self.ctl, self.tmax):
+                raise
+            return None
+
+
+def plan_control(lp: str, now: int, data: Data = (),
+                 options: Options = ()) -> Solution:
+    return deepen(now, Planner(lp, now, data, options).solve)
+
+
+planners: Dict[str, Callable[[str, int, Data, Options], Solution]] = {
+    'clingo': plan_clingo,
+    'control': plan_control,
+}
+
+
+class Program:
+    """The rules of a session, in the order they were added, indexed by the
+    name of the predicate they define and by the sentence they were
+    translated from, so that either can be taken back without going through
+    the whole program.
+
+    The proofs of a predicate are indexed along with its rules, and are
+    left out of the program unless they are asked for, or some other rule
+    uses them.
+
+    The file that each sentence came from is kept along with it, so that
+    the ground program can be traced back to them when profiling.
+    """
+    def __init__(self) -> None:
+        self.rules: Dict[int, Tuple[str, str, str, str]] = {}
+        self.heads: Dict[str, Set[int]] = {}
+        self.sources: Dict[str, Set[int]] = {}
+        self.proofs: Set[int] = set()
+        self.provers: Set[int] = set()
+        self.count = 0
+        self.texts: Dict[bool, str] = {}
+
+    def add(self, rule: str, source: str = '', file: str = '') -> None:
+        m = re.match(r'(?:proof\(@proof\()?(\w+)', rule)
+        name = m.group(1) if m else ''
+        self.count += 1
+        self.rules[self.count] = rule, name, source, file
+        self.heads.setdefault(name, set()).add(self.count)
+        self.sources.setdefault(source, set()).add(self.count)
+        if rule.startswith('proof(@proof('):
+            self.proofs.add(self.count)
+        elif 'proof(' in rule:
+            self.provers.add(self.count)
+        self.texts = {}
+
+    def undefine(self, name: str) -> None:
+        self.remove(self.heads.get(name, set()))
+
+    def forget(self, source: str) -> None:
+        self.remove(self.sources.get(source, set()))
+
+    def remove(self, ids: Set[int]) -> None:
+        for i in list(ids):
+            _, name, source, _ = self.rules.pop(i)
+            self.heads[name].discard(i)
+            self.sources[source].discard(i)
+            self.proofs.discard(i)
+            self.provers.discard(i)
+        self.texts = {}
+
+    def text(self, proofs: bool = True) -> str:
+        if proofs not in self.texts:
+            self.texts[proofs] = ''.join(
+                rule + '\n' for i, (rule, _, _, _) in self.rules.items()
+                if proofs or i not in self.proofs)
+        return self.texts[proofs]
+
+    def origins(self) -> Dict[str, str]:
+        """The sentence that each rule came from, and its file."""
+        return {rule: f'{file}: {source}' if file else source or rule
+                for rule, _, source, file in self.rules.values()}
+
+    def __str__(self) -> str:
+        return self.text()
 
 
 class ASPI:
-    def __init__(self, args: List[str] = []):
+    def __init__(self, args: List[str] = [], solver: str = 'control'):
+        if solver not in solvers and solver != 'session':
+            raise ValueError(f'unknown solver: {solver}')
         self.counter = 1
         self.facts = set(['moves(0)'])
-        self.ldcs = ldcs.LDCS()
+        self.ldcs = ldcs.LDCS(cache)
         self.now = 0
-        self.program = ''
-        self.proofs = True
+        self.program = Program()
+        self.data: Data = ()
+        self.proofs: Optional[bool] = None
+        self.magic = False
+        self.limit: Optional[int] = None
+        self.page = 1000
+        self.output: Optional[TextIO] = None
+        self.session = Session() if solver == 'session' else None
+        # held while a sentence is translated in a thread, by eval_async
+        self.lock = threading.Lock()
+        self.cache = QueryCache()
+        self.options: Dict[str, Options] = dict(OPTIONS)
+        self.stats = False
+        self.stats_output: Optional[TextIO] = None
+        self.last_stats: Optional[Dict[str, Any]] = None
+        self.profiling = False
+        self.profile_output: Optional[TextIO] = None
+        self.last_profile: Optional[Dict[str, Any]] = None
+        # the session solves questions itself, and the rest in-process
+        self.solve = solvers.get(solver, run_control)
+        self.plan = planners.get(solver, plan_control)
 
         for arg in ['lib/prelude.lp', 'lib/macros.ldcs', 'lib/plans.ldcs'] + args:
             self.include(arg)
 
     def include(self, arg: str) -> None:
+        self.cache.clear()
         if arg.endswith('.lp'):
-            self.program += f'#include "{arg}".\n'
+            run_scripts(arg)
+            self.program.add(f'#include "{arg}".')
         elif arg.endswith('.ldcs'):
             with open(arg, 'r') as f:
                 while True:
@@ -84,58 +1463,353 @@ class ASPI:
                         if 'macros' in arg:
                             self.ldcs.add_macro(lp.split('\n')[0])
                         else:
-                            self.program += lp + '\n'
+                            for rule in lp.split('\n'):
+                                if rule:
+                                    self.program.add(rule, line, arg)
                     except StopIteration:
                         break
         elif arg.endswith('.csv'):
-            with open(arg, 'r') as f:
-                rows = 0
-                for r, line in enumerate(f):
-                    rows += 1
-                    cols = 0
-                    for c, v in enumerate(line.split(',')):
-                        cols += 1
-                        v = v.strip()
-                        self.program += f'csv({v},{r+1},{c+1}).\n'
-                    self.program += f'csv_cols({cols},{r+1}).\n'
-                self.program += f'csv_rows({rows}).\n'
+            self.data += snapshots.load(arg, read_csv)
         elif arg.endswith('.txt'):
-            name = os.path.basename(arg)[:-4]
-            with open(arg, 'r') as f:
-                for line in f:
-                    k, v = line.split()
-                    self.program += f'{name}({v},{k}).\n'
+            self.data += snapshots.load(arg, read_txt)
 
     def repl(self, cmd: str) -> None:
         if not cmd or cmd.startswith('%'):
             return
         if cmd.startswith('#undef '):
-            name = cmd[len('#undef '):-1]
-            lines = self.program.split('\n')
-            for i in reversed(range(len(lines))):
-                line = lines[i]
-                if line.startswith(name) or f'@proof({name}' in line:
-                    lines.pop(i)
-            self.program = '\n'.join(lines)
+            self.program.undefine(cmd[len('#undef '):-1])
+            self.cache.clear()
+            return
+        if cmd.startswith('#forget '):
+            self.program.forget(cmd[len('#forget '):])
+            self.cache.clear()
             return
         if cmd.startswith('#include "'):
             return self.include(cmd[len('#include "'):-2])
         if cmd == 'thanks.':
             print("YOU'RE WELCOME!")
             sys.exit(0)
-        if cmd == '#proof off.':
-            self.proofs = False
+        if cmd in ('#proof on.', '#proof off.'):
+            self.proofs = cmd == '#proof on.'
+            return
+        if cmd in ('#magic on.', '#magic off.'):
+            self.magic = cmd == '#magic on.'
+            return
+        if cmd.startswith('#limit '):
+            if cmd == '#limit off.':
+                self.limit = None
+            elif (limit := setting(cmd, 0, 'N|off')) is not None:
+                self.limit = limit
+            return
+        if cmd.startswith('#cache '):
+            if (size := setting(cmd, 0)) is not None:
+                self.cache.size = size
+                self.cache.clear()
             return
-        res = self.eval(cmd)
+        if cmd.startswith('#options '):
+            kind, *args = cmd[len('#options '):-1].split()
+            options = tuple(args)
+            try:
+                assert kind in self.options, f'unknown kind: {kind}'
+                new_control([], options)
+            except (AssertionError, RuntimeError) as e:
+                print(e, file=sys.stderr)
+                return
+            self.options[kind] = options
+            return
+        if cmd.startswith('#stats '):
+            if self.stats_output is not None:
+                self.stats_output.close()
+                self.stats_output = None
+            self.stats = cmd != '#stats off.'
+            if cmd.startswith('#stats "'):
+                self.stats_output = open(cmd[len('#stats "'):-2], 'a')
+            return
+        if cmd.startswith('#profile '):
+            if self.profile_output is not None:
+                self.profile_output.close()
+                self.profile_output = None
+            self.profiling = cmd != '#profile off.'
+            if cmd.startswith('#profile "'):
+                self.profile_output = open(cmd[len('#profile "'):-2], 'a')
+            return
+        if cmd.startswith('#page '):
+            if (page := setting(cmd, 1)) is not None:
+                self.page = page
+            return
+        if cmd.startswith('#output '):
+            if self.output is not None:
+                self.output.close()
+                self.output = None
+            if cmd.startswith('#output "'):
+                self.output = open(cmd[len('#output "'):-2], 'w')
+            return
+        explain = cmd.startswith('#explain ')
+        if explain:
+            cmd = cmd[len('#explain '):]
+        with accounting:
+            optimization.update(costs=[], bounds=[])
+        before = self.measure()
+        start = time.perf_counter()
+        self.last_profile = None
+        res = self.eval(cmd, explain)
         if res is not None:
-            self.print(res)
-            for fact in self.facts:
-                if fact.startswith('moves('):
-                    self.now = int(fact[len('moves('):-1])
-            self.counter += 1
-
-    def eval(self, cmd: str) -> Optional['Results']:
-        lp = self.ldcs.toASP(cmd.replace('#macro ', ''))
+            self.conclude(res)
+        after = self.measure()
+        with accounting:
+            optimized = dict(optimization)
+        self.last_stats = {
+            'cmd': cmd, 'wall': time.perf_counter() - start,
+            **{k: after[k] - before[k] for k in after}, **optimized}
+        if self.stats:
+            self.report(self.last_stats)
+        if self.last_profile is not None:
+            self.report_profile(self.last_profile)
+
+    def measure(self) -> Dict[str, float]:
+        with accounting:
+            return {**timings, 'expand': self.ldcs.expanding, **statistics}
+
+    def report(self, stats: Dict[str, Any]) -> None:
+        print(f"% {stats['wall'] * 1000:.1f}ms:",
+              f"translate {stats['translate'] * 1000:.1f}ms",
+              f"(expand {stats['expand'] * 1000:.1f}ms),",
+              f"assemble {stats['assemble'] * 1000:.1f}ms,",
+              f"ground {stats['ground'] * 1000:.1f}ms,",
+              f"solve {stats['solve'] * 1000:.1f}ms;",
+              f"{stats['rules']} rules, {stats['atoms']} atoms,",
+              f"{stats['choices']} choices, {stats['conflicts']} conflicts,",
+              f"{stats['models']} models", file=sys.stderr)
+        if stats['costs']:
+            print(f"% {stats['optimal']} optimal;",
+                  f"costs {stats['costs']},",
+                  f"bounds {stats['bounds']}", file=sys.stderr)
+        if self.stats_output is not None:
+            print(json.dumps(stats), file=self.stats_output, flush=True)
+
+    def report_profile(self, profile: Dict[str, Any], top: int = 10) -> None:
+        print(f"% {'rules':>9} {'atoms':>9}  sentence", file=sys.stderr)
+        for row in profile['sentences'][:top]:
+            print(f"% {row['rules']:9} {row['atoms']:9}  {row['source']}",
+                  file=sys.stderr)
+        print(f"% {'rules':>9} {'atoms':>9}  predicate", file=sys.stderr)
+        for row in profile['predicates'][:top]:
+            print(f"% {row['rules']:9} {row['atoms']:9}  {row['predicate']}",
+                  file=sys.stderr)
+        if self.profile_output is not None:
+            print(json.dumps(profile), file=self.profile_output, flush=True)
+
+    def conclude(self, res: 'Results') -> None:
+        self.print(res)
+        self.advance()
+
+    def advance(self) -> None:
+        for fact in self.facts:
+            if fact.startswith('moves('):
+                self.now = int(fact[len('moves('):-1])
+        self.counter += 1
+
+    def eval(self, cmd: str, explain: bool = False) -> Optional['Results']:
+        translation = self.translate(cmd, explain)
+        if translation is None:
+            return None
+        return self.answer(cmd, *translation, explain)
+
+    def eval_many(self, cmds: List[str],
+                  outs: Optional[List[TextIO]] = None
+                  ) -> List[Optional['Results']]:
+        """Evaluate sentences in turn, like eval, except that runs of
+        questions which only define what they ask for are solved together,
+        grounding the program that they share once.
+
+        The session moves on past each sentence that is answered, as it
+        would on concluding it, so that only printing the results is left.
+        What is printed for each sentence on the way, such as its
+        translation, goes to its own stream of outs, if they're given.
+        """
+        results: List[Optional[Results]] = []
+        batch: List[Tuple[str, str, TextIO]] = []
+        program = ''
+        stateful: Dict[str, Set[str]] = {}
+        for cmd, out in zip(cmds, outs or [sys.stdout] * len(cmds)):
+            with contextlib.redirect_stdout(out):
+                translation = self.translate(cmd) \
+                    if cmd.endswith('?') else None
+            if translation is None:
+                results += self.solve_many(batch, program)
+                batch = []
+                with contextlib.redirect_stdout(out):
+                    res = self.eval(cmd) if not cmd.endswith('?') else None
+                if res is not None:
+                    self.advance()
+                results.append(res)
+                continue
+            lp, text = translation
+            if text != program:
+                results += self.solve_many(batch, program)
+                batch = []
+                program = text
+            if program not in stateful:
+                stateful[program] = dependents(
+                    program, set(['history', 'that']))
+            key = self.cache.key(self, lp, program)
+            if all(definite(rule) for rule in lp.split('\n') if rule) and \
+                    not stateful[program] & set(
+                        re.findall(r'\b([a-z]\w*)\(', lp)) and \
+                    (key is None or key not in self.cache.entries):
+                batch.append((cmd, lp, out))
+                continue
+            results += self.solve_many(batch, program)
+            batch = []
+            with contextlib.redirect_stdout(out):
+                res = self.answer(cmd, lp, program)
+            if res is not None:
+                self.advance()
+            results.append(res)
+        results += self.solve_many(batch, program)
+        return results
+
+    def solve_many(self, batch: List[Tuple[str, str, TextIO]],
+                   program: str) -> List[Optional['Results']]:
+        """Solve questions together, as the first of them, and move their
+        answers on to each question in turn, as when they're concluded."""
+        results: List[Optional[Results]] = []
+        witness: Optional[List[clingo.Symbol]] = None
+        stamp = self.counter
+        if len(batch) > 1:
+            lp = f'#const now = {self.now}.\n'
+            lp += f'#const counter = {self.counter}.\n'
+            lp += ''.join(fact + '.\n' for fact in self.facts)
+            lp += program
+            lp += '#show what/2.\n#show yes/1.\n#show no/1.\n'
+            lp += ''.join(tag(rule, i) + '\n'
+                          for i, (_, rules, _) in enumerate(batch)
+                          for rule in rules.split('\n') if rule)
+            if self.magic:
+                lp = magic_sets(lp)
+            try:
+                witness, _ = self.solve(lp, self.data, self.options['?'])
+            except ClingoError:
+                # one of the questions can't be answered, which is left
+                # to be reported when it is solved on its own
+                pass
+        if witness is None:
+            for cmd, lp, out in batch:
+                with contextlib.redirect_stdout(out):
+                    res = self.answer(cmd, lp, program)
+                if res is not None:
+                    self.advance()
+                results.append(res)
+            return results
+        shared = [atom for atom in witness if not (
+            atom.match('what', 2) or atom.match('yes', 1) or
+            atom.match('no', 1))]
+        found = set(witness)
+        for i, (_, lp, _) in enumerate(batch):
+            n = clingo.Number(i)
+            answers = [clingo.Function('what', [atom.arguments[1]])
+                       for atom in witness
+                       if atom.match('what', 2) and atom.arguments[0] == n]
+            answers += [clingo.Function('history', [
+                clingo.Number(stamp), answer]) for answer in answers]
+            answers += [clingo.Function(name) for name in ('yes', 'no')
+                        if clingo.Function(name, [n]) in found]
+            # the history of each question is restamped with its own counter
+            solution: Solution = shared + answers, []
+            query = lp, self.cache.key(self, lp, program), stamp, \
+                lambda: solution
+            results.append(self.results(query, solution))
+            self.advance()
+        return results
+
+    def answer(self, cmd: str, lp: str, program: str,
+               explain: bool = False) -> Optional['Results']:
+        query = self.query(cmd, lp, program, explain)
+        if query is None:
+            return None
+        try:
+            solution = query[-1]()
+            if self.profiling:
+                self.last_profile = self.profile(cmd, lp, program, solution)
+        except ClingoError as e:
+            self.error(e, query[0])
+            return None
+        return self.results(query, solution)
+
+    def profile(self, cmd: str, lp: str, program: str,
+                solution: Solution) -> Dict[str, Any]:
+        """Ground a question or command as it would be solved, and count the
+        ground rules and atoms that come of each sentence, and of each
+        predicate. A command is grounded at the horizon of its plan."""
+        origins = self.program.origins()
+        n = lp.count('\n')
+        lp = self.assemble(cmd, lp, program)
+        if cmd.endswith('!'):
+            witness, _ = solution
+            lp += horizon_program(max([self.now] + [
+                sym.arguments[0].arguments[0].number for sym in witness
+                if sym.match('assert', 1)
+                and sym.arguments[0].match('moves', 1)]))
+        # the lines of the question come first, then the facts
+        sources = [origins.get(line, cmd if i < n else '#facts')
+                   for i, line in enumerate(lp.split('\n'))]
+        return {'cmd': cmd, **profile_control(lp, sources, self.data)}
+
+    async def eval_async(self, cmd: str, timeout: float = TIME_LIMIT,
+                         on_model: Optional[
+                             Callable[[List[clingo.Symbol]], None]] = None
+                         ) -> Optional['Results']:
+        """Evaluate a sentence like eval, but translate and solve it in a
+        thread of its own, within the given time limit. Models are passed to
+        on_model, in the event loop, as they are found, and cancelling the
+        evaluation interrupts the solver.
+
+        Sentences are translated one at a time, as that changes the session,
+        but are solved alongside each other."""
+        loop = asyncio.get_running_loop()
+
+        def found(witness: List[clingo.Symbol]) -> None:
+            if on_model is not None:
+                loop.call_soon_threadsafe(on_model, witness)
+
+        def prepare() -> Optional[Query]:
+            with self.lock:
+                return self.prepare(cmd)
+
+        context = contextvars.copy_context()
+        current = Interrupt(timeout, found)
+        context.run(interrupts.set, current)
+        try:
+            query = await loop.run_in_executor(None, context.run, prepare)
+        except asyncio.CancelledError:
+            current.cancel()
+            raise
+        if query is None:
+            return None
+        lp, _, _, solve = query
+        try:
+            solution = await loop.run_in_executor(None, context.run, solve)
+        except asyncio.CancelledError:
+            current.cancel()
+            raise
+        except ClingoError as e:
+            self.error(e, lp)
+            return None
+        return self.results(query, solution)
+
+    def prepare(self, cmd: str, explain: bool = False) -> Optional[Query]:
+        translation = self.translate(cmd, explain)
+        if translation is None:
+            return None
+        return self.query(cmd, *translation, explain)
+
+    def translate(self, cmd: str,
+                  explain: bool = False) -> Optional[Tuple[str, str]]:
+        """Translate a sentence, and either add it to the program or return
+        the rules of its question or command, along with the program that
+        they are to be solved with."""
+        with timed('translate'):
+            lp = self.ldcs.toASP(cmd.replace('#macro ', ''))
         if lp is None:
             return None
         print('-->', '\n    '.join(
@@ -147,34 +1821,86 @@ class ASPI:
                 if cmd.startswith('#macro'):
                     if line.strip() and '@proof' not in line:
                         self.ldcs.add_macro(line)
-                else:
-                    if self.proofs or '@proof' not in line:
-                        self.program += line + '\n'
+                elif line and (self.proofs is not False or
+                               '@proof' not in line):
+                    self.program.add(line, cmd)
+            self.cache.clear()
             print('understood.\n')
             return None
 
-        lp += f'#const now = {self.now}.\n'
-        lp += f'#const counter = {self.counter}.\n'
-        lp += ''.join(fact + '.\n' for fact in self.facts)
-        lp += self.program
-        if cmd.endswith('!'):
-            lp += '#include "lib/planner.lp".\n'
+        # proofs are only grounded when they are asked for, either by the
+        # question or by the program (to tell the elements of bags apart)
+        proofs = bool(self.proofs or explain or self.program.provers or any(
+            'proof(' in line for line in lp.split('\n')
+            if '@proof' not in line))
+        if not proofs:
+            lp = ''.join(line + '\n' for line in lp.split('\n')
+                         if line and '@proof' not in line)
+        if explain:
+            lp += '#show proof(P,what(X)) : proof(P,what(X)).\n'
+        return lp, self.program.text(proofs)
+
+    def query(self, cmd: str, lp: str, program: str,
+              explain: bool = False) -> Optional[Query]:
+        """Get a question or command ready to be solved on its own, against
+        the program and facts as they are now."""
+        key: Optional[CacheKey] = None
+        if cmd.endswith('?') and not explain:
+            key = self.cache.key(self, lp, program)
+        solution = None if key is None else self.cache.get(key, self.counter)
+        if solution is not None:
+            key = None
+
         try:
-            return Results(self, run_clingo(lp))
-        except sh.ErrorReturnCode as e:
-            if e.exit_code == ClingoExitCode.INTERRUPT:
-                print('timeout.\n')
-                return None
-            elif e.exit_code == ClingoExitCode.EXHAUST:
-                print('impossible.\n')
-                return None
-            else:
-                print(e.stderr.decode('utf-8'), file=sys.stderr)
-                print(ClingoExitCode(e.exit_code), file=sys.stderr)
-                for i, line in enumerate(lp.split('\n')):
-                    if not line.startswith('csv('):
-                        print(f'{i+1:3}|', line, file=sys.stderr)
-                sys.exit(1)
+            if solution is None and self.session is not None \
+                    and cmd.endswith('?') and not explain:
+                solution = self.session.solve(self, lp, program)
+        except ClingoError as e:
+            self.error(e, lp)
+            return None
+        if solution is not None:
+            found: Solution = solution
+            return lp, key, self.counter, lambda: found
+
+        lp = self.assemble(cmd, lp, program)
+        if cmd.endswith('!'):
+            return lp, key, self.counter, functools.partial(
+                self.plan, lp, self.now, self.data, self.options['!'])
+        return lp, key, self.counter, functools.partial(
+            self.solve, lp, self.data, self.options['?'])
+
+    def assemble(self, cmd: str, lp: str, program: str) -> str:
+        with timed('assemble'):
+            lp += f'#const now = {self.now}.\n'
+            lp += f'#const counter = {self.counter}.\n'
+            lp += ''.join(fact + '.\n' for fact in self.facts)
+            lp += program
+            if cmd.endswith('!'):
+                lp += '#include "lib/planner.lp".\n'
+            elif self.magic:
+                lp = magic_sets(lp)
+        return lp
+
+    def results(self, query: Query, solution: Solution) -> 'Results':
+        _, key, counter, _ = query
+        if key is not None:
+            self.cache.put(key, solution, counter)
+        witness, costs = solution
+        if costs:
+            print_costs(costs)
+        return Results(self, restamp(witness, counter, self.counter))
+
+    def error(self, e: ClingoError, lp: str) -> None:
+        if e.exit_code == ClingoExitCode.INTERRUPT:
+            print('timeout.\n')
+        elif e.exit_code == ClingoExitCode.EXHAUST:
+            print('impossible.\n')
+        else:
+            print(e.stderr, file=sys.stderr)
+            print(ClingoExitCode(e.exit_code), file=sys.stderr)
+            for i, line in enumerate(lp.split('\n')):
+                print(f'{i+1:3}|', line, file=sys.stderr)
+            sys.exit(1)
 
     def print(self, res: 'Results') -> None:
         for fact in res.already:
@@ -184,50 +1910,94 @@ class ASPI:
         if res.status:
             print(res.status + '.')
         if res.shows:
-            terms = [clingo.parse_term(r) for r in res.shows]
-            terms.sort()
-            that = ' | '.join(res.replace_names(str(t)) for t in terms)
-            if len(that) / len(terms) > 30:
-                that = that.replace(' | ', '\n    | ')
-            print(f'that: {that}.')
+            self.show(res, self.output or sys.stdout)
+        for proof in sorted(res.proofs):
+            print('because:', res.replace_names(str(proof)) + '.')
         print()
 
+    def show(self, res: 'Results', out: TextIO) -> None:
+        """Write the answers to a question a page at a time, laid out on
+        one line unless the answers on the first page are long."""
+        terms = sorted(res.shows)
+        n = len(terms) if self.limit is None else min(self.limit, len(terms))
+        sep = ' | '
+        for i in range(0, n, self.page):
+            page = [res.replace_names(str(t))
+                    for t in terms[i:min(i + self.page, n)]]
+            if i == 0:
+                if len(sep.join(page)) / len(page) > 30:
+                    sep = '\n    | '
+                out.write('that: ')
+            else:
+                out.write(sep)
+            out.write(sep.join(page))
+            out.flush()
+        if n < len(terms):
+            out.write(sep if n else 'that: ')
+            out.write(f'({len(terms) - n} more)')
+        out.write('.\n')
+
 
 class Results:
-    def __init__(self, parent: ASPI, results: List[str]) -> None:
+    def __init__(self, parent: ASPI, results: List[clingo.Symbol]) -> None:
         self.parent = parent
         self.status: Optional[str] = None
         self.acts: List[str] = []
         self.already: List[str] = []
-        self.shows: List[str] = []
+        self.shows: List[clingo.Symbol] = []
+        self.proofs: List[clingo.Symbol] = []
         self.names: Dict[str, str] = {}
-        for result in results:
+        self.resolved: Dict[str, str] = {}
+        self.pattern: Optional[re.Pattern[str]] = None
+        self.plan: List[Tuple[int, str]] = []
+        # the order of atoms within a model depends on the solver backend,
+        # so retractions (of the previous state) always come first and acts
+        # are ordered by time step
+        for result in sorted(results, key=lambda r: not r.match('retract', 1)):
             self.parse(result)
+        self.compile_names()
         self.acts = [self.replace_names(act, t)
-                     for t, act in enumerate(self.acts)]
+                     for t, (_, act) in enumerate(sorted(self.plan))]
         self.already = [self.replace_names(fact) for fact in self.already]
 
     def replace_names(self, s: str, offset: int = 0) -> str:
-        while True:
-            r = s
-            for k, v in self.names.items():
-                if k[-1] == ')':
-                    r = r.replace(k, v)
-                else:
-                    r = re.sub('\\b' + k + '\\b', v, r)
-            if s == r:
-                return s
-            s = r
-
-    def parse(self, result: str) -> None:
+        if self.pattern is None:
+            return s
+        return self.pattern.sub(lambda m: self.resolve(m.group(0)), s)
+
+    def compile_names(self) -> None:
+        # longer names come first, so that a name isn't replaced by a
+        # shorter one that it starts with
+        names = sorted(self.names, key=len, reverse=True)
+        if names:
+            self.pattern = re.compile('|'.join(
+                re.escape(k) if k[-1] == ')' else f'\\b{re.escape(k)}\\b'
+                for k in names))
+
+    def resolve(self, name: str) -> str:
+        # names are described in terms of other names, which are replaced
+        # once, when a name is first used; a name that is already being
+        # resolved is left as it is
+        if name not in self.resolved:
+            assert self.pattern is not None
+            self.resolved[name] = name
+            self.resolved[name] = self.pattern.sub(
+                lambda m: self.resolve(m.group(0)), self.names[name])
+        return self.resolved[name]
+
+    def parse(self, atom: clingo.Symbol) -> None:
+        if atom.match('what', 1):
+            self.shows.append(atom.arguments[0])
+            return
+        if atom.match('proof', 2):
+            self.proofs.append(atom.arguments[0])
+            return
+        result = str(atom)
         if result.startswith('assert('):
             self.parse_assert(result)
         elif result.startswith('retract('):
             result = result[len('retract('):-1]
             self.parent.facts.remove(result)
-        elif result.startswith('what('):
-            result = result[len('what('):-1]
-            self.shows.append(result)
         elif result.startswith('history('):
             self.parent.facts.add(result)
         elif result.startswith('already('):
@@ -242,12 +2012,181 @@ class Results:
     def parse_assert(self, result: str) -> None:
         result = result[len('assert('):-1]
         self.parent.facts.add(result)
-        m = re.fullmatch(r'apply\((.*),\d+\)', result)
+        m = re.fullmatch(r'apply\((.*),(\d+)\)', result)
         if m:
-            self.acts.append(m.group(1).replace(',', ', '))
+            self.plan.append((int(m.group(2)), m.group(1).replace(',', ', ')))
+
+
+class Server:
+    """Serve one session to many clients, over a Unix socket or TCP, with
+    a request and a reply per line, each a JSON object:
+
+        {"id": 1, "cmd": "fib[20]?"}
+        {"id": 1, "output": "--> what(A) :- fib(A,20).\\nthat: 6765..."}
+
+    Statements, commands and the session's own commands change the session
+    and are run one at a time. Questions are translated against the
+    session as it is when they arrive, and then solved in a pool of
+    workers, so that their replies may come back out of order. A request
+    that fails gets a reply with an "error" instead.
+    """
+    def __init__(self, args: List[str] = [], workers: int = 4) -> None:
+        self.args = args
+        self.aspi = ASPI(args)
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+    def run(self, f: Callable[[], Any]) -> Tuple[Any, Dict[str, Any]]:
+        """Call f with the session to itself, and capture what it prints."""
+        result = None
+        reply: Dict[str, Any] = {}
+        out, err = io.StringIO(), io.StringIO()
+        with self.lock, contextlib.redirect_stdout(out), \
+                contextlib.redirect_stderr(err):
+            try:
+                result = f()
+            except SystemExit as e:
+                if e.code:
+                    reply['error'] = err.getvalue()
+        reply['output'] = out.getvalue()
+        return result, reply
+
+    def request(self, line: str,
+                reply: Callable[[Dict[str, Any]], None]) -> None:
+        try:
+            request = json.loads(line)
+            cmd = request['cmd'].strip()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            reply({'error': 'bad request'})
+            return
+        id = request.get('id')
+        if cmd == '#reset.':
+            _, replied = self.run(self.reset)
+            reply({'id': id, **replied})
+        elif not cmd.endswith('?') or cmd.startswith('#'):
+            _, replied = self.run(lambda: self.aspi.repl(cmd))
+            reply({'id': id, **replied})
+        else:
+            aspi = self.aspi
+            query, replied = self.run(lambda: aspi.prepare(cmd))
+            if query is None:
+                reply({'id': id, **replied})
+            else:
+                self.pool.submit(self.answer, aspi, id, query,
+                                 replied['output'], reply)
+
+    def reset(self) -> None:
+        self.aspi = ASPI(self.args)
+
+    def answer(self, aspi: ASPI, id: Any, query: Query, output: str,
+               reply: Callable[[Dict[str, Any]], None]) -> None:
+        lp, _, _, solve = query
+        try:
+            solution = solve()
+            _, replied = self.run(
+                lambda: aspi.conclude(aspi.results(query, solution)))
+        except ClingoError as e:
+            error = e
+            _, replied = self.run(lambda: aspi.error(error, lp))
+        except Exception as e:
+            # the question is answered in a worker, which would otherwise
+            # drop the exception and leave the client waiting for a reply
+            traceback.print_exc()
+            reply({'id': id, 'error': f'{type(e).__name__}: {e}',
+                   'output': output})
+            return
+        reply({'id': id, **replied, 'output': output + replied['output']})
+
+    def listen(self, address: str) -> socketserver.BaseServer:
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                lock = threading.Lock()
+
+                def reply(message: Dict[str, Any]) -> None:
+                    with lock:
+                        self.wfile.write(json.dumps(message).encode() + b'\n')
+                        self.wfile.flush()
+
+                for line in self.rfile:
+                    if line.strip():
+                        server.request(line.decode(), reply)
+
+        host, _, port = address.rpartition(':')
+        if port.isdigit():
+            return socketserver.ThreadingTCPServer((host, int(port)), Handler)
+        return socketserver.ThreadingUnixStreamServer(address, Handler)
+
+
+def sentences(lines: Iterator[str]) -> Iterator[Tuple[str, str]]:
+    """Read sentences to the end of the input, each along with the lines
+    it was read from as the REPL would echo them, and comments and blank
+    lines as empty sentences."""
+    for line in lines:
+        cmd = line.rstrip('\n')
+        echo = '>>> ' + cmd
+        if len(cmd) == 0 or cmd[0] == '%':
+            yield '', echo
+            continue
+        while cmd[-1] not in '.?!':
+            cont = next(lines, None)
+            if cont is None:
+                return
+            echo += '\n... ' + cont.rstrip('\n')
+            cmd += cont.rstrip('\n')
+        yield cmd, echo
+    yield 'thanks.', '>>> thanks.'
+
+
+def batch(args: List[str], lines: Iterator[str]) -> None:
+    """Read sentences to the end of the input, evaluating each run of
+    questions together, and print each one's translation and answer after
+    it, as the REPL would."""
+    aspi = ASPI(args)
+    # questions waiting to be answered, along with the lines they were read
+    # from, and the comments in between
+    questions: List[Tuple[str, str]] = []
+
+    def answer() -> None:
+        cmds = [cmd for cmd, _ in questions if cmd]
+        outs = [io.StringIO() for _ in cmds]
+        results = iter(zip(aspi.eval_many(cmds, list(outs)), outs))
+        for cmd, echo in questions:
+            print(echo)
+            if not cmd:
+                continue
+            res, out = next(results)
+            print(out.getvalue(), end='')
+            if res is not None:
+                aspi.print(res)
+        questions.clear()
+
+    for cmd, echo in sentences(lines):
+        if not cmd or cmd.endswith('?') and not cmd.startswith('#'):
+            questions.append((cmd, echo))
+            continue
+        answer()
+        print(echo)
+        if cmd == '#reset.':
+            aspi = ASPI(args)
+        else:
+            aspi.repl(cmd)
+    # the input ended in the middle of a sentence
+    answer()
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        with Server(sys.argv[3:]).listen(sys.argv[2]) as listener:
+            listener.serve_forever()
+        sys.exit(0)
+    if sys.argv[1:2] == ['--batch']:
+        batch(sys.argv[2:], sys.stdin)
+        sys.exit(0)
     aspi = ASPI(sys.argv[1:])
     while True:
         try:
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Run the test scripts in a pool of processes, timing each script and each
+sentence within it, and compare the timings with those of a baseline.
+
+    ./bench.py [-j JOBS] [-o bench.json] [-b baseline.json] [names...]
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import aspi
+
+STAGES = ['translate', 'ground', 'solve']
+# differences smaller than these are noise, whatever the tolerance
+FLOORS = {'wall': 0.05, 'translate': 0.05, 'ground': 0.05, 'solve': 0.05,
+          'peak_rss': 10240}
+
+
+def scripts() -> List[str]:
+    return sorted(path[len('test/'):-len('.ldcs')]
+                  for path in glob.glob('test/**/*.ldcs', recursive=True)
+                  if os.path.exists(path[:-len('.ldcs')] + '.log'))
+
+
+def peak_rss() -> int:
+    """The peak resident set size in kilobytes, of this process or of any
+    clingo process it has run, since it started. taken after each query it
+    is the peak so far, not the memory that query used."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run(name: str) -> Dict[str, Any]:
+    args = [f'test/{name}.csv'] if os.path.exists(f'test/{name}.csv') else []
+    out = io.StringIO()
+    queries: List[Dict[str, Any]] = []
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out), open(f'test/{name}.ldcs') as f:
+        session = aspi.ASPI(args)
+        for cmd, echo in aspi.sentences(f):
+            print(echo)
+            if not cmd:
+                continue
+            timings = dict(aspi.timings)
+            t = time.perf_counter()
+            try:
+                if cmd == '#reset.':
+                    session = aspi.ASPI(args)
+                else:
+                    session.repl(cmd)
+            except SystemExit:
+                pass
+            queries.append({
+                'cmd': cmd,
+                'wall': time.perf_counter() - t,
+                **{stage: aspi.timings[stage] - timings[stage]
+                   for stage in STAGES},
+                'peak_rss': peak_rss(),
+            })
+    with open(f'test/{name}.log') as f:
+        passed = out.getvalue() == f.read()
+    return {
+        'passed': passed,
+        'wall': time.perf_counter() - start,
+        **{stage: sum(q[stage] for q in queries) for stage in STAGES},
+        'peak_rss': peak_rss(),
+        'queries': queries,
+    }
+
+
+def bench(names: List[str], jobs: Optional[int] = None
+          ) -> Dict[str, Dict[str, Any]]:
+    # a fresh process for each script, so that its peak memory is its own
+    with multiprocessing.Pool(jobs, maxtasksperchild=1) as pool:
+        return dict(zip(names, pool.map(run, names, chunksize=1)))
+
+
+def compare(results: Dict[str, Dict[str, Any]],
+            baseline: Dict[str, Dict[str, Any]],
+            tolerance: float = 0.25) -> List[str]:
+    """Describe the scripts that fail, or that have become slower or use
+    more memory than the baseline by more than the given fraction."""
+    regressions = []
+    for name, result in results.items():
+        if not result['passed']:
+            regressions.append(f'{name}: output differs from the log')
+        if name not in baseline:
+            continue
+        for key, floor in FLOORS.items():
+            old, new = baseline[name][key], result[key]
+            if new > old * (1 + tolerance) and new - old > floor:
+                regressions.append(f'{name}: {key} {old:.6g} -> {new:.6g}')
+    return regressions
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*', default=scripts())
+    parser.add_argument('-j', '--jobs', type=int)
+    parser.add_argument('-o', '--output', default='bench.json')
+    parser.add_argument('-b', '--baseline')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.25)
+    opts = parser.parse_args(argv)
+
+    results = bench(opts.names, opts.jobs)
+    with open(opts.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'{"script":16} {"wall":>8} {"translate":>9} {"ground":>8} '
+          f'{"solve":>8} {"peak RSS":>8}')
+    for name, result in results.items():
+        print(f'{name:16} {result["wall"]:8.2f} {result["translate"]:9.2f} '
+              f'{result["ground"]:8.2f} {result["solve"]:8.2f} '
+              f'{result["peak_rss"] // 1024:6}MB'
+              + ('' if result['passed'] else '  FAILED'))
+
+    baseline: Dict[str, Dict[str, Any]] = {}
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, opts.tolerance)
+    for regression in regressions:
+        print(regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
+import functools
+import hashlib
+import json
 import lark
+import os
 import re
 import string
 import sys
-from typing import Callable, Dict, Iterable, List, \
-        Optional, Protocol, Tuple, TypeVar
+import time
+from typing import cast, Any, Callable, Dict, Iterable, List, \
+        Optional, Protocol, Set, Tuple, TypeVar
 
 # https://arxiv.org/abs/1309.4408
 
-ebnf = r'''
+# the terminals and the expressions that sentences are made of, which the
+# grammars below share
+terminals = r'''
 %import common.DIGIT
 %import common.ESCAPED_STRING
 %import common.INT
@@ -17,37 +24,20 @@ ebnf = r'''
 %import common.LETTER
 %import common.WS
 %ignore WS
-_WS: WS
 
 INEQ_OP: "!=" | "<=" | ">=" | "<" | ">"
-CMP_OP: "=" | INEQ_OP
 BIN_OP: ".." | "**" | "+" | "-" | "*" | "/" | "\\" | "&" | "?" | "^"
 SUP_SUFFIX: "'est" | "'each" | "'th" | "'"
 VARIABLE: UCASE_LETTER ("_"|LETTER|DIGIT)*
 NAME: ["@"] LCASE_LETTER ("_"|LETTER|DIGIT)*
+'''
 
-start: cmd
-?cmd: "#" "fluent" pred [":-" pred ("," pred)*] "." -> fluent
-    | "#" "enum" atom ":" lams ("|" lams)* "." -> enum
-    | define_heads ":" ldcs "." -> define
-    | disj "::" define_heads [":-" clause] "." -> reverse_define
-    | pred [":-" clause] "." -> claim
-    | clause "-:" pred "." -> reverse_claim
-    | ldcs "?" -> query
-    | ":-" clause "?" -> query_any
-    | ldcs "!" -> goal
-    | [":-" pred ("," pred)*] "!" -> goal_any
-define_heads: (func | join)+
+expressions = r'''
 clause: term ("," term)*
-term: atom "(" [ldcs ("," ldcs)*] ")"
-    | ldcs CMP_OP ldcs -> binop_term
-    | "not" term -> not_term
 pred: atom "(" [ldcs ("," ldcs)*] ")"
-cmpop: ldcs CMP_OP ldcs -> binop
 binop: bracketed BIN_OP bracketed
 ?bracketed: "(" ldcs ")"
           | arg -> ldcs
-rparam: INT ldcs
 atom: NAME
 ldcs: disj [":-" clause]
 disj: conj ("|" conj)*
@@ -68,7 +58,7 @@ constant: INT
     | pred -> unify
     | "(" "-" bracketed ")" -> negative
     | "(" INEQ_OP ldcs ")" -> ineq
-    | [func] "{{" ldcs "}}" -> bagof
+    | [func] "{{" ldcs "}" "}" -> bagof
     | [func] "{" ldcs "}" -> setof
 func: atom
     | (func | constant) SUP_SUFFIX -> superlative
@@ -77,6 +67,84 @@ join: func "." bracketed
     | func "=" bracketed -> reverse_join
 '''
 
+ebnf = terminals + r'''
+_WS: WS
+CMP_OP: "=" | INEQ_OP
+
+start: cmd
+?cmd: "#" "fluent" pred [":-" pred ("," pred)*] "." -> fluent
+    | "#" "enum" atom ":" lams ("|" lams)* "." -> enum
+    | define_heads ":" ldcs "." -> define
+    | disj "::" define_heads [":-" clause] "." -> reverse_define
+    | pred [":-" clause] "." -> claim
+    | clause "-:" pred "." -> reverse_claim
+    | ldcs "?" -> query
+    | ":-" clause "?" -> query_any
+    | ldcs "!" -> goal
+    | [":-" pred ("," pred)*] "!" -> goal_any
+define_heads: (func | join)+
+term: atom "(" [ldcs ("," ldcs)*] ")"
+    | ldcs CMP_OP ldcs -> binop_term
+    | "not" term -> not_term
+cmpop: ldcs CMP_OP ldcs -> binop
+rparam: INT ldcs
+''' + expressions
+
+# The same language arranged for an LALR(1) parser, which is much faster than
+# Earley. The final punctuation mark picks the start symbol, and operands of
+# comparisons are parsed by the op_ rules, which cannot start with a
+# reverse_join, so that one token of lookahead is enough to tell them apart.
+# Whitespace between lambdas is only a token where another lambda can follow.
+lalr_ebnf = terminals + r'''
+_RCLAIM.3: "-:"
+_WS.2: /(?<=[\w")\]}'])\s+(?=[\w"(~{])/
+CMP_OP: INEQ_OP
+EQUAL: "="
+
+statement: "#" "fluent" pred [":-" pred ("," pred)*] -> fluent
+    | "#" "enum" atom ":" lams ("|" lams)* -> enum
+    | define_heads ":" ldcs -> define
+    | disj "::" define_heads [":-" clause] -> reverse_define
+    | pred [":-" clause] -> claim
+    | first_clause _RCLAIM pred -> reverse_claim
+question: ldcs -> query
+    | ":-" clause -> query_any
+command: ldcs -> goal
+    | [":-" pred ("," pred)*] -> goal_any
+define_heads: (func | join) (_WS? (func | join))*
+first_clause: first_term ("," term)* -> clause
+first_term: atom "(" [ldcs ("," ldcs)*] ")" -> term
+    | operand (CMP_OP | EQUAL) ldcs -> binop_term
+    | "not" term -> not_term
+term: atom "(" [ldcs ("," ldcs)*] ")"
+    | operand (CMP_OP | EQUAL) ldcs -> binop_term
+    | "not" term -> not_term
+operand: op_disj -> ldcs
+op_disj: op_conj ("|" conj)* -> disj
+    | "_" -> disj
+    | op_conj ("||" conj)+ -> short_disj
+op_conj: op_lams -> conj
+op_lams: op_lam (_WS lam)* -> lams
+?op_lam.2: op_arg
+    | op_binop -> unify
+    | op_bracketed "@" bracketed -> adverb
+?op_arg.2: func
+    | constant
+    | op_join
+    | "~" bracketed -> neg
+    | pred -> unify
+    | "(" "-" bracketed ")" -> negative
+    | "(" INEQ_OP ldcs ")" -> ineq
+    | [func] "{{" ldcs "}" "}" -> bagof
+    | [func] "{" ldcs "}" -> setof
+?op_paren.2: "(" ldcs ")"
+op_binop: op_bracketed BIN_OP bracketed -> binop
+?op_bracketed: op_paren
+    | op_arg -> ldcs
+op_join.2: func "." bracketed -> join
+    | func "[" ldcs ("," ldcs)* "]" -> join
+''' + expressions
+
 Sym = str
 CSym = Tuple[Sym, Optional[str]]
 Unary = Callable[[Sym], str]
@@ -89,7 +157,77 @@ class Variadic(Protocol):
     def __call__(self, *args: Sym) -> str: ...
 
 
-parser = lark.Lark(ebnf)
+class Lifted(Protocol):
+    """A lifted body, applied to a variable, under the name it was lifted
+    to unless another one is given."""
+    def __call__(self, x: Sym, name: str = ...) -> str: ...
+
+
+# macros of the prelude that clingo can aggregate by itself
+aggregates = {
+    'count': 'countof',
+    'sum': 'sumof',
+    'min': 'minof',
+    'max': 'maxof',
+}
+# the predicates that the elements of such aggregates, and the aggregates
+# themselves, are derived under start with this, like gather_sentinel
+AGGREGATE = 'aggregate_'
+
+# the predicates that lifted bodies are derived under, which are told apart
+# by their closures, like negation((2),A), rather than by their names
+LIFTED = {'negation', 'disjunction', 'aggregation', 'setof', 'bagof',
+          'gather', 'gather_index'}
+ATOM = re.compile(r'(?<![@\w])([a-z]\w*)\((?:\((\d+)[,)])?')
+
+
+# the parse trees of sentences and macros. lark-parser's trees aren't
+# generic, unlike those of lark 1.x, which would be lark.Tree[lark.Token]
+Tree = lark.Tree
+
+moods = {'.': 'statement', '?': 'question', '!': 'command'}
+
+
+# the parsers are built when they're first used, as that takes longer than
+# the rest of importing this module
+@functools.lru_cache(maxsize=None)
+def parser() -> lark.Lark:
+    return lark.Lark(ebnf)
+
+
+@functools.lru_cache(maxsize=None)
+def lalr_parser() -> lark.Lark:
+    return lark.Lark(lalr_ebnf, parser='lalr', start=list(moods.values()))
+
+
+def parse(s: str) -> Tree:
+    if s[-1:] in moods:
+        try:
+            tree = lalr_parser().parse(s[:-1], start=moods[s[-1]])
+            return Tree('start', [tree])
+        except lark.exceptions.UnexpectedInput:
+            pass
+    # a few sentences, like `p (X, Y)`, need more lookahead
+    return parser().parse(s)
+
+
+def dependencies(head: str, body: List[str]
+                 ) -> Tuple[Optional[str], Set[Tuple[str, bool]]]:
+    """The predicate that a rule defines, and those that its body uses,
+    each along with whether it is used under negation or in an aggregate."""
+    m = ATOM.match(head)
+    uses = set()
+    for term in body:
+        negated = term.startswith('not ') or term.startswith('#')
+        for name, closure in ATOM.findall(term):
+            uses.add((predicate(name, closure), negated))
+    return (predicate(*m.groups()) if m else None), uses
+
+
+def predicate(name: str, closure: Optional[str]) -> str:
+    if closure and (name in LIFTED or name.startswith(AGGREGATE)):
+        return f'{name}/{closure}'
+    return name
 
 
 def unzip(pairs: Iterable[Tuple[S, T]]) -> Tuple[List[S], List[T]]:
@@ -105,12 +243,205 @@ def commas(*args: Optional[str]) -> str:
     return ', '.join(arg for arg in args if arg)
 
 
+def terms(body: str) -> List[str]:
+    """Split a conjunction on the commas outside of string constants."""
+    if '"' not in body:
+        return body.split(', ')
+    out = ['']
+    for i, part in enumerate(re.split(r'("(?:[^"\\]|\\.)*")', body)):
+        if i % 2:
+            out[-1] += part
+        else:
+            first, *rest = part.split(', ')
+            out[-1] += first
+            out += rest
+    return out
+
+
+INTEGER = r'(-?\d+|\(- ?\d+\))'
+FLIPPED = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '=': '='}
+
+
+def integer(s: str) -> int:
+    return int(s.strip('()').replace(' ', ''))
+
+
+def numeral(n: int) -> str:
+    return str(n) if n >= 0 else f'(- {-n})'
+
+
+def narrow(body: List[str], notes: Optional[List[str]] = None) -> List[str]:
+    """Tighten the intervals of a conjunction, like the A = 1 .. 9999 of the
+    type n4, to the bounds that the comparisons of the same variable (or of
+    one it equals) with constants put on them, and step them over the
+    multiples that they are filtered to. Each interval that is narrowed is
+    noted in notes."""
+    if any(t.count('(') != t.count(')') or t.count('{') != t.count('}') or
+           ';' in t for t in body):
+        return body  # a term that was split, or a disjunction
+    alias: Dict[str, str] = {}
+
+    def find(var: str) -> str:
+        while var in alias:
+            var = alias[var]
+        return var
+
+    for t in body:
+        if m := re.fullmatch(r'([A-Z]\w*) = ([A-Z]\w*)', t):
+            if find(m[1]) != find(m[2]):
+                alias[find(m[1])] = find(m[2])
+    lo: Dict[str, int] = {}
+    hi: Dict[str, int] = {}
+    steps: Dict[str, Tuple[int, int]] = {}
+    for t in body:
+        bounds = []
+        if m := re.fullmatch(fr'([A-Z]\w*) (<|<=|>|>=|=) {INTEGER}', t):
+            bounds.append((m[1], m[2], integer(m[3])))
+        elif m := re.fullmatch(fr'{INTEGER} (<|<=|>|>=|=) ([A-Z]\w*)', t):
+            bounds.append((m[3], FLIPPED[m[2]], integer(m[1])))
+        elif m := re.fullmatch(
+                fr'([A-Z]\w*) = {INTEGER} ?\.\. ?{INTEGER}', t):
+            bounds += [(m[1], '>=', integer(m[2])),
+                       (m[1], '<=', integer(m[3]))]
+        elif m := re.fullmatch(r'\(([A-Z]\w*) \\ (\d+)\) = (\d+)', t):
+            if 0 <= int(m[3]) < int(m[2]):
+                steps.setdefault(find(m[1]), (int(m[2]), int(m[3])))
+        for var, op, n in bounds:
+            var = find(var)
+            if op in ('<', '<=', '='):
+                hi[var] = min(hi.get(var, n), n - (op == '<'))
+            if op in ('>', '>=', '='):
+                lo[var] = max(lo.get(var, n), n + (op == '>'))
+
+    out = []
+    for t in body:
+        m = re.fullmatch(fr'([A-Z]\w*) = {INTEGER} ?\.\. ?{INTEGER}', t)
+        if m:
+            var = find(m[1])
+            a, b = lo[var], hi[var]
+            step, rest = steps.get(var, (1, 0))
+            if rest and a < 0:
+                # the remainder of a negative number depends on how it is
+                # rounded
+                step, rest = 1, 0
+            a, b = -((rest - a) // step), (b - rest) // step
+            if (a, b, step) != (integer(m[2]), integer(m[3]), 1):
+                interval = f'{numeral(a)} .. {numeral(b)}'
+                if step > 1:
+                    interval = f'{step}*({interval})'
+                if rest:
+                    interval += f'+{rest}'
+                narrowed = f'{m[1]} = {interval}'
+                if notes is not None:
+                    values = integer(m[3]) - integer(m[2]) + 1
+                    notes.append(f'% narrowed {t} to {narrowed} '
+                                 f'({values} to {max(0, b - a + 1)} values)')
+                t = narrowed
+        out.append(t)
+    return out
+
+
+class Rule:
+    """A rule of the translated program, rendered to ASP at the very end.
+
+    Its body is kept as a list of terms. The translation still builds bodies
+    as text, so a rule splits the text of its body into terms once, when it
+    is made."""
+    __slots__ = ('head', 'body')
+
+    def __init__(self, head: str, body: Optional[str] = None) -> None:
+        self.head = head
+        self.body = terms(body) if body else []
+
+    def __str__(self) -> str:
+        body = [term for term in self.body if term]
+        if not body:
+            return f'{self.head}.'
+        # a conditional literal ends with the ; that separates it from the
+        # next term, and with nothing at the end of the body
+        text = ''.join(term + (' ' if term.endswith(';') else ', ')
+                       for term in body[:-1])
+        return f'{self.head} :- {text}{body[-1].rstrip(";")}.'
+
+
+def pending_context(rule: Rule) -> Optional[str]:
+    if rule.body and rule.body[-1].startswith('@context('):
+        return rule.body[-1][len('@context('):-1]
+    return None
+
+
+# the grammar and its translation to ASP both live in this module
+with open(__file__, 'rb') as f:
+    VERSION = hashlib.sha1(f.read()).hexdigest()
+
+
+class Cache:
+    """Translations of sentences, kept on disk between sessions, and evicted
+    least recently used first.
+
+    A translation is keyed on the sentence, the counters it starts from and
+    the version of the grammar. It records the macros that were looked up
+    while translating it, and is only reused while they are unchanged.
+    """
+    def __init__(self, path: str, size: int = 10000) -> None:
+        self.path = path
+        self.size = size
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.changed = False
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def key(self, s: str, counts: Dict[str, int]) -> str:
+        return hashlib.sha1(json.dumps(
+            [VERSION, s, sorted(counts.items())]).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(key)
+        if entry is not None and next(reversed(self.entries)) != key:
+            # the most recently used come last, as they're kept on disk
+            del self.entries[key]
+            self.entries[key] = entry
+            self.changed = True
+        return entry
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+            del self.entries[next(iter(self.entries))]
+        self.changed = True
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + '.tmp', self.path)
+        self.changed = False
+
+
 @lark.v_args(inline=True)
 class LDCS(lark.Transformer[str]):
-    def __init__(self) -> None:
+    def __init__(self, cache: Optional[Cache] = None) -> None:
         self.counts: Dict[str, int] = {}
-        self.rules: List[str] = []
-        self.macros: Dict[str, Tuple[List[Sym], lark.Tree]] = {}
+        self.rules: List[Rule] = []
+        self.macros: Dict[str, Tuple[List[Sym], Tree]] = {}
+        self.sources: Dict[str, str] = {}
+        self.used: Dict[str, Optional[str]] = {}
+        self.cache = cache
+        # the predicates that the rules of the statements translated so far
+        # use, to tell whether an aggregate can be left to clingo
+        self.graph: Dict[str, Set[Tuple[str, bool]]] = {}
+        self.native = True
+        self.unstratified = False
+        # the intervals narrowed in translating the last sentence, which
+        # are reported when debugging
+        self.narrowed: List[str] = []
+        # seconds spent expanding contexts, for profiling
+        self.expanding = 0.0
 
     def counter(self, prefix: str = '') -> int:
         if prefix not in self.counts:
@@ -126,16 +457,16 @@ class LDCS(lark.Transformer[str]):
             i -= len(string.ascii_uppercase)
             return f'X{i}'
 
-    def lift(self, var_body: CSym, prefix: str, **kwargs) -> Unary:
+    def lift(self, var_body: CSym, prefix: str, **kwargs) -> Lifted:
         return self.lifts([var_body], prefix, **kwargs)
 
     def lifts(self, var_bodies: List[CSym], prefix: str,
               context: bool = True, ground: bool = False,
-              gather: bool = False) -> Unary:
+              gather: bool = False, members: str = 'gather') -> Lifted:
         # TODO: only suppress context for vars not used in the parent context
         #       this has functional effects for aggregations
         vars, bodies = unzip(var_bodies)
-        prefix_gather = 'gather' if gather else prefix
+        prefix_gather = members if gather else prefix
         i = self.counter(prefix_gather)
         muvars = []
         if context:
@@ -152,15 +483,16 @@ class LDCS(lark.Transformer[str]):
                 if ground:
                     args = f'{var},{args}'
                 body = commas(body, f'@context({args})')
-                if prefix == 'setof':
-                    self.rules.append(f'gather_index(({closure})) :- @context({args}).')
-            if body:
-                self.rules.append(f'{f(var, prefix_gather)} :- {body}.')
-            else:
-                self.rules.append(f'{f(var, prefix_gather)}.')
+                if prefix == 'setof' or prefix.startswith(AGGREGATE):
+                    self.rules.append(Rule(
+                        f'{prefix_gather}_index(({closure}))',
+                        f'@context({args})'))
+            self.rules.append(Rule(f(var, prefix_gather), body))
         return f
 
     def expand_macro(self, name: str, *args: Sym) -> str:
+        self.used[f'{name}/{len(args)}'] = \
+            self.sources.get(f'{name}/{len(args)}')
         if f'{name}/{len(args)}' in self.macros:
             params, tree = self.macros[f'{name}/{len(args)}']
             subst = dict(zip(params, args))
@@ -171,96 +503,178 @@ class LDCS(lark.Transformer[str]):
             return f"{name}({','.join(args)})"
 
     def expand_contexts(self) -> None:
-        updated = False
-        for i, rule in enumerate(self.rules):
-            if (match := re.search(r'@context\((.*)\)', rule)):
-                pred = match.group(1)
-                groundvar = None
-                if pred[1] == ',':
-                    groundvar = pred[0]
-                    pred = pred[2:]
-                template = re.escape(pred).replace('_', '([A-Z0])')
-                for rule2 in self.rules:
-                    if ' :- ' in rule2:
-                        body = rule2[:-1].split(' :- ')[1].split(', ')
-                        for j, term in enumerate(body):
-                            if (match2 := re.search(template, term)):
-                                headvar = match2.group(1)
-                                context = []
-                                for t in body[:j] + body[j+1:]:
-                                    if '((' in t and not t.startswith('@context'):
-                                        continue
-                                    elif not re.search(fr'\b{headvar}\b', t) \
-                                            and t[2] not in '<>' \
-                                            and 'Mu' in pred:
-                                        context.append(t)
-                                    elif groundvar and '..' in t and \
-                                            t.startswith(f'{headvar} = '):
-                                        context.append(groundvar + t[1:])
-                                    elif groundvar and \
-                                            t.endswith(f'({headvar})'):
-                                        context.append(
-                                            t.replace(headvar, groundvar))
-                                rule = rule.replace(
-                                    match.group(0), commas(*context))
-                                rule = rule.replace(', .', '.')
-                                self.rules[i] = rule
-                                updated = True
-        if updated:
-            self.expand_contexts()
-
-    def start(self, rule: Optional[str]) -> str:
+        # index the body terms that use each closure, like setof((1,MuX),A)
+        uses: Dict[str, List[Tuple[int, int]]] = {}
+        for k, rule in enumerate(self.rules):
+            for j, term in enumerate(rule.body):
+                for closure in set(re.findall(r'\((\([^()]*\)),', term)):
+                    uses.setdefault(closure, []).append((k, j))
+        # the context copied into a rule may itself need expanding, which is
+        # done in the next round, once every rule of this round is expanded
+        pending = [i for i, rule in enumerate(self.rules)
+                   if pending_context(rule)]
+        while pending:
+            expanded = []
+            for i in pending:
+                if self.expand_context(i, uses):
+                    expanded.append(i)
+            pending = [i for i in expanded if pending_context(self.rules[i])]
+
+    def expand_context(self, i: int,
+                       uses: Dict[str, List[Tuple[int, int]]]) -> bool:
+        rule = self.rules[i]
+        pred = pending_context(rule)
+        if not pred:
+            return False
+        groundvar = None
+        if pred[1] == ',':
+            groundvar = pred[0]
+            pred = pred[2:]
+        # the variable _ that stands for the head variable, rather than the
+        # underscores of names like aggregate_member
+        template = re.sub(r'(?<!\w)_(?!\w)', '([A-Z0])', re.escape(pred))
+        closure = re.search(r'\((\([^()]*\)),', pred)
+        for k, j in uses.get(closure.group(1), []) if closure else []:
+            body = self.rules[k].body
+            if j >= len(body) or not (match2 := re.search(template, body[j])):
+                continue
+            headvar = match2.group(1)
+            context = []
+            for t in body[:j] + body[j+1:]:
+                if '((' in t and not t.startswith('@context'):
+                    continue
+                elif not re.search(fr'\b{headvar}\b', t) \
+                        and t[2] not in '<>' \
+                        and 'Mu' in pred:
+                    context.append(t)
+                elif groundvar and '..' in t and \
+                        t.startswith(f'{headvar} = '):
+                    context.append(groundvar + t[1:])
+                elif groundvar and \
+                        t.endswith(f'({headvar})'):
+                    context.append(
+                        t.replace(headvar, groundvar))
+            rule.body[-1:] = context
+            return True
+        return False
+
+    def start(self, rule: Optional[Rule]) -> str:
         if rule:
-            self.rules.insert(0, rule + '.')
+            self.rules.insert(0, rule)
+        start = time.perf_counter()
         self.expand_contexts()
+        self.expanding += time.perf_counter() - start
+        if self.native and not self.stratified():
+            self.unstratified = True
+            return ''
+        for rule in self.rules:
+            rule.body = narrow(rule.body, self.narrowed)
         for rule in self.rules[:]:
-            if '{' not in rule and not rule.startswith(':-'):
+            text = str(rule)
+            for term in rule.body:
+                if term.startswith('#') and f'{AGGREGATE}member((' in term:
+                    text = text.replace(term, '')
+            if '{' not in text and not text.startswith(':-'):
                 self.rules.append(self.proof(rule))
-        return '\n'.join(self.rules) \
-                   .replace(';,', ';') \
-                   .replace(';.', '.') \
-                   .replace(' :- .', '.')
+        return '\n'.join(str(rule) for rule in self.rules)
+
+    def stratified(self) -> bool:
+        """Whether the elements of each aggregate that clingo is left to
+        find, given the statements translated so far, depend neither on the
+        aggregate itself nor on anything that depends on itself through
+        negation or through another aggregate.
+
+        Only the aggregates of the sentence being translated are checked. A
+        later statement can still close such a cycle through an aggregate
+        that was left to clingo, which then aggregates it by its own
+        semantics for recursive aggregates rather than gathering it."""
+        graph: Dict[str, Set[Tuple[str, bool]]] = {}
+        aggregated = []
+        for rule in self.rules:
+            head, uses = dependencies(rule.head, rule.body)
+            if head is not None:
+                graph.setdefault(head, set()).update(uses)
+                if head.startswith(AGGREGATE) and \
+                        any(term.startswith('#') for term in rule.body):
+                    aggregated.append(head)
+
+        def edges(name: str) -> Set[Tuple[str, bool]]:
+            if name in self.graph:
+                # the translation is only reused while they are unchanged
+                self.used[f'depends {name}'] = \
+                    self.source(f'depends {name}')
+                return graph.get(name, set()) | self.graph[name]
+            return graph.get(name, set())
+
+        reached: Dict[str, Set[str]] = {}
+
+        def reach(name: str) -> Set[str]:
+            if name not in reached:
+                seen, stack = {name}, [name]
+                while stack:
+                    for used, _ in edges(stack.pop()):
+                        if used not in seen:
+                            seen.add(used)
+                            stack.append(used)
+                reached[name] = seen
+            return reached[name]
+
+        return not any(negated and above in reach(used)
+                       for head in aggregated for above in reach(head)
+                       for used, negated in edges(above))
+
+    def depend(self, lp: str) -> None:
+        for line in lp.split('\n'):
+            if ' :- ' in line and not line.startswith('proof('):
+                head, body = line[:-1].split(' :- ', 1)
+                name, uses = dependencies(head, terms(body))
+                if name is not None:
+                    self.graph.setdefault(name, set()).update(uses)
+
+    def source(self, name: str) -> Optional[str]:
+        """The source of a macro, or the uses of a predicate by the
+        statements translated so far."""
+        if name.startswith('depends '):
+            uses = self.graph.get(name[len('depends '):])
+            return None if uses is None else repr(sorted(uses))
+        return self.sources.get(name)
 
     def define(self, heads: List[Unary], var_body: CSym) -> None:
         var, body = var_body
         for head in reversed(heads):
-            lhs = head(var).split(', ')
-            self.rules.insert(0, f'{lhs[0]} :- {commas(*lhs[1:], body)}.')
+            lhs = terms(head(var))
+            self.rules.insert(0, Rule(lhs[0], commas(*lhs[1:], body)))
 
     def reverse_define(self, lam: Unary, heads: List[Unary], cond: Optional[str] = None) -> None:
         return self.define(heads, self.ldcs(lam, cond))
 
-    def fluent(self, head_body: CSym, *args: CSym) -> str:
+    def fluent(self, head_body: CSym, *args: CSym) -> Rule:
         head, body = head_body
         if len(args) > 0:
             for v, b in args:
                 body = commas(body, f'holds({v},Time)', b)
-            self.rules.append(f'holds({head},Time) :- {body}.')
-        return f'{head} :- holds({head})'
+            self.rules.append(Rule(f'holds({head},Time)', body))
+        return Rule(head, f'holds({head})')
 
-    def proof(self, rule: str) -> str:
-        if ' :- ' in rule:
-            head, body = rule[:-1].split(' :- ')
-        else:
-            head = rule[:-1]
-            body = ''
-        terms = []
+    def proof(self, rule: Rule) -> Rule:
+        head = rule.head
+        body = []
         pvars = []
-        for term in body.split(', '):
+        for term in rule.body:
             if ' = @' in term and ':' not in term and ';' not in term:
-                terms.append(term)
+                body.append(term)
                 var = 'P' + str(self.counter('proof'))
                 eq = term.replace(' = @', ',')
-                terms.append(f'{var} = eq({eq})')
+                body.append(f'{var} = eq({eq})')
                 pvars.append(var)
             elif ' ' in term:
-                terms.append(term)
+                body.append(term)
             elif term.strip():
                 var = 'P' + str(self.counter('proof'))
-                terms.append(f'proof({var},{term})')
+                body.append(f'proof({var},{term})')
                 pvars.append(var)
         prf = ','.join([head] + pvars)
-        return f'proof(@proof({prf}),{head}) :- {commas(*terms)}.'
+        return Rule(f'proof(@proof({prf}),{head})', commas(*body))
 
     def enum(self, head: str, *args: List[Unary]) -> None:
         for lams in args:
@@ -270,46 +684,41 @@ class LDCS(lark.Transformer[str]):
                                  for lam in lams if ', ' not in lam('')
                                                 and ',)' not in lam(''))
             if describe:
-                self.rules.append(f'describe({name}, {describe}).')
-            self.rules.append(f'{head}({name}).')
-            self.rules.append(f'{head}({name},{i}).')
+                self.rules.append(Rule(f'describe({name}, {describe})'))
+            self.rules.append(Rule(f'{head}({name})'))
+            self.rules.append(Rule(f'{head}({name},{i})'))
             for lam in lams:
-                self.rules.append(lam(name).replace(', ', ' :- ', 1) + '.')
+                rule = terms(lam(name))
+                self.rules.append(Rule(rule[0], commas(*rule[1:])))
 
-    def claim(self, head_body: CSym, cond: Optional[str] = None) -> str:
+    def claim(self, head_body: CSym, cond: Optional[str] = None) -> Rule:
         head, body = head_body
-        return f'{head} :- {commas(body, cond)}'
+        return Rule(head, commas(body, cond))
 
-    def reverse_claim(self, cond: Optional[str], head_body: CSym) -> str:
+    def reverse_claim(self, cond: Optional[str], head_body: CSym) -> Rule:
         head, body = head_body
-        return f'{head} :- {commas(body, cond)}'
+        return Rule(head, commas(body, cond))
 
-    def query(self, var_body: CSym) -> str:
+    def query(self, var_body: CSym) -> Rule:
         var, body = var_body
-        if body:
-            return f'what({var}) :- {body}'
-        else:
-            return f'what({var})'
+        return Rule(f'what({var})', body)
 
     def query_any(self, body: Optional[str]) -> None:
-        self.rules += [f'yes :- {body}.', 'no :- not yes.']
+        self.rules += [Rule('yes', body), Rule('no', 'not yes')]
 
     def clause(self, *args: str) -> str:
         return commas(*args)
 
-    def goal_any(self, *args: CSym) -> Optional[str]:
+    def goal_any(self, *args: CSym) -> Optional[Rule]:
         if args:
             self.fluent(('done', None), *args)
-            return 'goal(done)'
+            return Rule('goal(done)')
         else:
-            return ''
+            return None
 
-    def goal(self, var_body: CSym) -> str:
+    def goal(self, var_body: CSym) -> Rule:
         var, body = var_body
-        if body is None:
-            return f'goal({var})'
-        else:
-            return f'goal({var}) :- {body}'
+        return Rule(f'goal({var})', body)
 
     def define_heads(self, *args: Unary) -> List[Unary]:
         return list(args)
@@ -340,7 +749,7 @@ class LDCS(lark.Transformer[str]):
         return commas(*self.binop(a, op, b))
 
     def not_term(self, term: str, lift: bool = False) -> str:
-        if ', ' in term or lift:
+        if len(terms(term)) > 1 or lift:
             term = self.lift(('0', term), 'negation')('0')
         return f'not {term}'
 
@@ -352,9 +761,8 @@ class LDCS(lark.Transformer[str]):
         return name
 
     def ldcs(self, lam: Unary, cond: Optional[str] = None) -> CSym:
-        head_body = lam('_').split(', ', 1)
-        head = head_body[0]
-        body = head_body[1] if len(head_body) > 1 else ''
+        head, *rest = terms(lam('_'))
+        body = commas(*rest)
         if head.startswith('_ = ') and \
                 not re.search(r'\b_\b', body) and \
                 '..' not in head:
@@ -391,7 +799,7 @@ class LDCS(lark.Transformer[str]):
         return lambda x: f'{x} = {c}'
 
     def func(self, name: str) -> Variadic:
-        return lambda *args: self.expand_macro(name, *args)
+        return functools.partial(self.expand_macro, name)
 
     def superlative(self, rel: Variadic, op: str) -> Variadic:
         if op == "'":
@@ -424,18 +832,58 @@ class LDCS(lark.Transformer[str]):
 
     def setof(self, a, b=None) -> Unary:
         if b is not None:
-            return self.join(a, self.ldcs(self.setof(b)))
+            return self.aggregate(a, b) or \
+                self.join(a, self.ldcs(self.setof(b)))
         return self.lift(a, 'setof', gather=True)
 
     def bagof(self, a, b=None) -> Unary:
         if b is not None:
-            return self.join(a, self.ldcs(self.bagof(b)))
-        var, body = a
+            return self.aggregate(a, b, bag=True) or \
+                self.join(a, self.ldcs(self.bagof(b)))
+        return self.lift(self.bag_element(a), 'bagof', gather=True)
+
+    def bag_element(self, var_body: CSym) -> CSym:
+        var, body = var_body
         if body is not None and ' ' in body:
             var, body = self.ldcs(self.lift((var, body), 'aggregation'))
-        var = f'({var},P0)'
-        body = f'proof(P0,{body})'
-        return self.lift((var, body), 'bagof', gather=True)
+        return f'({var},P0)', f'proof(P0,{body})'
+
+    def aggregate(self, rel: Variadic, var_body: CSym,
+                  bag: bool = False) -> Optional[Unary]:
+        # the elements of a set that one of the prelude's macros aggregates
+        # are aggregated by clingo, unless they depend on the aggregate, or
+        # on anything else through negation, in which case the sentence is
+        # translated again to gather them all while grounding (see start)
+        if not isinstance(rel, functools.partial) or \
+                rel.args[0] not in aggregates:
+            return None
+        name = rel.args[0]
+        if not self.native:
+            return None
+        if self.expand_macro(name, 'X', 'L') != \
+                f'X = @{aggregates[name]}(L)':
+            return None
+        if bag:
+            var_body = self.bag_element(var_body)
+        # the aggregate is derived by a rule of its own, like a set, so that
+        # its elements are only grounded once for each context
+        prefix = AGGREGATE + aggregates[name]
+        members = AGGREGATE + 'member'
+        f = self.lift(var_body, prefix, gather=True, members=members)
+        y = self.gensym()
+        element = f'{y} : {f(y, members)}'
+        if bag and name != 'count':
+            # the elements of a bag are told apart by their proofs
+            w = self.gensym()
+            element = f'{w},{y} : {f(y, members)},{y} = ({w},_)'
+        v = self.gensym()
+        index = None
+        closure = f('_')[len(prefix) + 1:-len(',_)')]
+        if ',' in closure:
+            index = f'{members}_index({closure})'
+        self.rules.append(Rule(f(v), commas(f'#{name}{{{element}}} = {v}',
+                                            index)))
+        return f
 
     def unify(self, pred_body: CSym) -> Unary:
         pred, body = pred_body
@@ -444,16 +892,51 @@ class LDCS(lark.Transformer[str]):
     def adverb(self, var_body: CSym, adverb_body: CSym) -> Unary:
         var, body = var_body
         assert body is not None
-        head_body = body.split(', ', 1)
-        head = head_body[0]
-        body = head_body[1] if len(head_body) > 1 else ''
+        head, *rest = terms(body)
+        body = commas(*rest)
         avar, abody = adverb_body
         return lambda x: commas(f'{x} = {var}, event({avar},{head})', body, abody)
 
     def toASP(self, s: str) -> Optional[str]:
+        key = '' if self.cache is None else self.cache.key(s, self.counts)
+        entry = None if self.cache is None else self.cache.get(key)
+        lp: Optional[str]
+        if entry is not None and all(
+                self.source(name) == source
+                for name, source in entry['used'].items()):
+            self.counts = dict(entry['counts'])
+            lp = cast(str, entry['lp'])
+            narrowed = cast(List[str], entry.get('narrowed', []))
+        else:
+            self.used = {}
+            lp = self.translate(s)
+            narrowed = self.narrowed
+            if lp is not None and self.cache is not None:
+                self.cache.put(key, {
+                    'lp': lp, 'used': self.used, 'counts': dict(self.counts),
+                    'narrowed': narrowed})
+        if 'DEBUG' in os.environ:
+            for note in narrowed:
+                print(note, file=sys.stderr)
+        if lp is not None and s.endswith('.'):
+            self.depend(lp)
+        return lp
+
+    def translate(self, s: str) -> Optional[str]:
+        self.narrowed = []
+        counts = dict(self.counts)
         try:
-            tree = parser.parse(s)
-            return self.transform(tree)
+            tree = parse(s)
+            lp = self.transform(tree)
+            if self.unstratified:
+                # gather the elements of every aggregate while grounding,
+                # numbered as if the first translation hadn't happened
+                self.counts = dict(counts)
+                self.narrowed = []
+                self.rules = []
+                self.native = False
+                lp = self.transform(tree)
+            return lp
         except lark.exceptions.UnexpectedInput as e:
             print('Syntax error:', e, file=sys.stderr)
             return None
@@ -463,11 +946,14 @@ class LDCS(lark.Transformer[str]):
         finally:
             self.counts[''] = 0
             self.rules = []
+            self.native = True
+            self.unstratified = False
 
     def add_macro(self, s: str) -> None:
-        tree = rule_parser.parse(s)
+        tree = rule_parser().parse(s)
         name, args = RuleHead().transform(tree)
         self.macros[f'{name}/{len(args)}'] = args, tree
+        self.sources[f'{name}/{len(args)}'] = s
 
 
 rule_ebnf = r'''
@@ -499,7 +985,10 @@ var: VARIABLE
 head: ATOM "(" value ("," value)* ")"
 '''
 
-rule_parser = lark.Lark(rule_ebnf)
+
+@functools.lru_cache(maxsize=None)
+def rule_parser() -> lark.Lark:
+    return lark.Lark(rule_ebnf, parser='lalr')
 
 
 @lark.v_args(inline=True)
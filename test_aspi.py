@@ -34,3 +34,672 @@ def test_script(script_runner, name):
             f.write(ret.stdout)
     assert ret.stdout == open(f'test/{name}.log', 'r').read()
     assert ret.stderr == ''
+
+
+@pytest.mark.parametrize('solver', ['clingo', 'control', 'session'])
+def test_solver(capsys, solver):
+    from aspi import ASPI
+    aspi = ASPI(solver=solver)
+    for cmd in ['fib[0]: 0.', 'fib[1]: 1.',
+                'fib[N 2..20]: fib[N-1] + fib[N-2].', 'fib[10]?',
+                ':- fib(2,1)?', 'count{1..5 | 7}?', 'pickup(1)!']:
+        aspi.repl(cmd)
+    out = capsys.readouterr().out
+    assert 'that: 55.\n' in out
+    assert 'no.\n' in out
+    assert 'that: 6.\n' in out
+    assert 'impossible.\n' in out
+
+
+def test_session_parts(capsys, monkeypatch):
+    import aspi
+    monkeypatch.setattr(aspi, 'SESSION_QUERIES', 2)
+    session = aspi.ASPI(solver='session')
+    session.repl('fib[0]: 0.')
+    session.repl('fib[1]: 1.')
+    session.repl('fib[N 2..20]: fib[N-1] + fib[N-2].')
+    controls = []
+    for n in range(5, 10):
+        session.repl(f'fib[{n}]?')
+        controls.append(session.session.ctl)
+    out = capsys.readouterr().out
+    assert 'that: 5.\n' in out and 'that: 34.\n' in out
+    # the parts of two queries at most are kept in each solver
+    assert [len(set(map(id, controls[i:i + 2]))) for i in (0, 2)] == [1, 1]
+    assert len(set(map(id, controls))) == 3
+
+
+def test_unknown_solver():
+    from aspi import ASPI
+    with pytest.raises(ValueError, match='unknown solver: contrl'):
+        ASPI(solver='contrl')
+
+
+def test_plan_horizon(capsys):
+    from aspi import ASPI
+    aspi = ASPI()
+    for cmd in ['init: at(0).',
+                'forward(N) :: action demands.at(N) deletes.at(N) '
+                'adds.at(N+1) :- N = 0..29.',
+                'at(25)!']:
+        aspi.repl(cmd)
+    out = capsys.readouterr().out
+    assert 'forward(24)!\n' in out
+    assert 'forward(25)!\n' not in out
+
+
+@pytest.mark.parametrize('solver', ['clingo', 'control'])
+def test_plan_cost(capsys, solver):
+    from aspi import ASPI
+    aspi = ASPI(solver=solver)
+    for cmd in ['edge["a","c"]: 10.', 'edge["a","b"]: 1.',
+                'edge["b","d"]: 1.', 'edge["d","c"]: 1.',
+                'edge(A,B) :- exists(edge[A,B]).', 'init: at("a").',
+                'go(A,B) :: action demands.at(A) deletes.at(A) adds.at(B) '
+                'costs.edge[A,B] :- edge(A,B).',
+                'at("c")!', 'count{time}?']:
+        aspi.repl(cmd)
+    out = capsys.readouterr().out
+    assert 'cost: 3.\n' in out
+    assert 'go("d", "c")!\n' in out
+    assert 'that: 23.\n' in out
+
+
+def test_translation_cache(tmp_path, monkeypatch):
+    import ldcs
+    path = str(tmp_path / 'ldcs.cache')
+    sentences = ['p(X) :- q(X).', 'twice.X: X * 2.', 'twice.{p}?']
+    translator = ldcs.LDCS()
+    expected = [translator.toASP(s) for s in sentences]
+    cache = ldcs.Cache(path)
+    translator = ldcs.LDCS(cache)
+    assert [translator.toASP(s) for s in sentences] == expected
+    cache.save()
+
+    translate = ldcs.LDCS.translate
+    monkeypatch.setattr(ldcs.LDCS, 'translate', None)
+    translator = ldcs.LDCS(ldcs.Cache(path))
+    assert [translator.toASP(s) for s in sentences] == expected
+
+    # only the sentence that uses a changed macro is translated again
+    monkeypatch.setattr(ldcs.LDCS, 'translate', translate)
+    fresh = ldcs.LDCS()
+    fresh.add_macro('q(X) :- r(X).')
+    translator = ldcs.LDCS(ldcs.Cache(path))
+    translator.add_macro('q(X) :- r(X).')
+    assert translator.toASP(sentences[0]) == fresh.toASP(sentences[0])
+    assert translator.toASP(sentences[0]) != expected[0]
+
+
+def test_translation_cache_size(tmp_path, monkeypatch, capsys):
+    import ldcs
+    cache = ldcs.Cache(str(tmp_path / 'ldcs.cache'), size=2)
+    translator = ldcs.LDCS(cache)
+    for s in ['p(1).', 'p(2).', 'p(1).', 'p(3).']:
+        translator.toASP(s)
+    assert len(cache.entries) == 2
+    assert cache.get(cache.key('p(2).', translator.counts)) is None
+
+    # the intervals narrowed are reported whether or not they're cached
+    monkeypatch.setenv('DEBUG', '1')
+    for translator in [ldcs.LDCS(cache), ldcs.LDCS(cache)]:
+        translator.toASP('q(A) :- A = 1..100, A < 10.')
+        assert '% narrowed A = 1 .. 100 to A = 1 .. 9' in \
+            capsys.readouterr().err
+
+
+def translate(path):
+    import ldcs
+    translator = ldcs.LDCS()
+    with open('lib/macros.ldcs', 'r') as f:
+        for line in f:
+            if line.strip() and line[0] != '%':
+                lp = translator.toASP(line.strip())
+                translator.add_macro(lp.split('\n')[0])
+    out = []
+    with open(path, 'r') as f:
+        lines = iter(f)
+        for line in lines:
+            line = line.strip()
+            if len(line) == 0 or line[0] == '%':
+                continue
+            while line[-1] not in '.?!':
+                line += next(lines, '.').strip()
+            lp = translator.toASP(line.replace('#macro ', ''))
+            out.append(lp)
+            if line.startswith('#macro') and lp is not None:
+                for rule in lp.split('\n'):
+                    if rule.strip() and '@proof' not in rule:
+                        translator.add_macro(rule)
+    return out
+
+
+@pytest.mark.parametrize('name', scripts)
+def test_lalr_parser(monkeypatch, name):
+    import lark
+    import ldcs
+    expected = translate(f'test/{name}.ldcs')
+    monkeypatch.setattr(ldcs, 'parse', ldcs.parser().parse)
+    monkeypatch.setattr(ldcs, 'rule_parser',
+                        lambda: lark.Lark(ldcs.rule_ebnf))
+    assert translate(f'test/{name}.ldcs') == expected
+
+
+def test_string_with_comma():
+    import ldcs
+    lp = ldcs.LDCS().toASP('hi(X) :- greet(X, "a, b").')
+    assert lp.split('\n')[0] == 'hi(MuX) :- greet(MuX,"a, b").'
+    lp = ldcs.LDCS().toASP('~greet."a, b"?')
+    assert 'negation((1),A) :- greet(A,"a, b").' in lp.split('\n')
+
+
+def test_rule_conditional():
+    import ldcs
+    rule = ldcs.Rule('p(X)', 'q(X) : r(X);, s(X), t(Y) : u(Y);')
+    assert rule.body == ['q(X) : r(X);', 's(X)', 't(Y) : u(Y);']
+    assert str(rule) == 'p(X) :- q(X) : r(X); s(X), t(Y) : u(Y).'
+
+
+def test_program_statements():
+    import aspi
+    import clingo
+    lp = 'p(1).\nq(X) :- p(X).\n#show q/1.\n'
+    assert aspi.run_control(lp) == ([clingo.parse_term('q(1)')], [])
+    parsed = aspi.statements['p(1).']
+    witness, _ = aspi.run_control(lp + 'p(2).\n')
+    assert sorted(map(str, witness)) == ['q(1)', 'q(2)']
+    assert aspi.statements['p(1).'] is parsed
+    with pytest.raises(aspi.ClingoError) as e:
+        aspi.run_control(lp + 'p(.\n')
+    assert 'syntax error' in e.value.stderr
+    with pytest.raises(aspi.ClingoError) as e:
+        aspi.run_control('#include "lib/prelude.lp".\n'
+                         'p(@concatenate(1,2)).\n')
+    assert '@concatenate: ' in e.value.stderr
+
+
+def test_data_snapshots(tmp_path):
+    import aspi
+    import clingo
+    path = tmp_path / 'table.csv'
+    path.write_text('1, bob, "x y"\n-2, alice, x y, \n')
+    snapshots = aspi.Snapshots(str(tmp_path / 'data.cache'))
+    data = snapshots.load(str(path), aspi.read_csv)
+    assert clingo.parse_term('csv("x y",1,3)') in data
+    assert clingo.parse_term('csv("x y",2,3)') in data
+    assert clingo.parse_term('csv("",2,4)') in data
+    assert clingo.parse_term('csv(-2,2,1)') in data
+    assert clingo.parse_term('csv_cols(4,2)') in data
+    assert data[-1] == clingo.parse_term('csv_rows(2)')
+    assert snapshots.load(str(path), aspi.read_csv) is data
+    snapshots.save()
+
+    snapshots = aspi.Snapshots(str(tmp_path / 'data.cache'))
+    assert snapshots.load(str(path), None) == data
+    path.write_text('3\n')
+    os.utime(path, ns=(0, 0))
+    assert snapshots.load(str(path), aspi.read_csv)[0] == \
+        clingo.parse_term('csv(3,1,1)')
+
+
+@pytest.mark.parametrize('solver', ['clingo', 'control', 'session'])
+def test_data_facts(capsys, solver):
+    from aspi import ASPI
+    aspi = ASPI(['test/oeis/b200975.txt'], solver=solver)
+    aspi.repl('b200975[10]?')
+    aspi.repl('count{b200975[1..5]}?')
+    out = capsys.readouterr().out
+    assert 'that: 31.\n' in out
+    assert 'that: 5.\n' in out
+
+
+def test_program_store(capsys):
+    from aspi import ASPI
+    aspi = ASPI()
+    base = str(aspi.program)
+    for cmd in ['fib[0]: 0.', 'fib[1]: 1.', 'fibs: 2.',
+                'fib[N 2..20]: fib[N-1] + fib[N-2].']:
+        aspi.repl(cmd)
+    aspi.repl('#undef fib.')
+    assert str(aspi.program) == \
+        base + 'fibs(2).\nproof(@proof(fibs(2)),fibs(2)).\n'
+    aspi.repl('fib[0]: 0.')
+    aspi.repl('#forget fibs: 2.')
+    aspi.repl('#forget fib[0]: 0.')
+    assert str(aspi.program) == base
+
+
+def test_proofs_on_demand(capsys):
+    from aspi import ASPI
+    aspi = ASPI()
+    for cmd in ['fib[0]: 0.', 'fib[1]: 1.',
+                'fib[N 2..5]: fib[N-1] + fib[N-2].']:
+        aspi.repl(cmd)
+    assert '@proof' in aspi.program.text(True)
+    assert '@proof' not in aspi.program.text(False)
+    capsys.readouterr()
+    aspi.repl('fib[3]?')
+    assert 'because' not in capsys.readouterr().out
+    aspi.repl('#explain fib[3]?')
+    out = capsys.readouterr().out
+    assert 'that: 2.\nbecause: proof((what(2),fib(1,2),fib(2,3)),' in out
+
+
+def test_query_cache(capsys):
+    from aspi import ASPI
+    aspi = ASPI()
+    for cmd in ['fib[0]: 0.', 'fib[1]: 1.',
+                'fib[N 2..20]: fib[N-1] + fib[N-2].', 'fib[20]?', 'fib[20]?']:
+        aspi.repl(cmd)
+    assert (aspi.cache.hits, aspi.cache.misses) == (1, 1)
+    assert 'history(2,what(6765))' in aspi.facts
+    aspi.repl('that?')
+    assert (aspi.cache.hits, aspi.cache.misses) == (1, 1)
+    aspi.repl('#forget fib[0]: 0.')
+    aspi.repl('fib[0]: 1.')
+    aspi.repl('fib[20]?')
+    assert (aspi.cache.hits, aspi.cache.misses) == (1, 2)
+    assert capsys.readouterr().out.endswith('that: 10946.\n\n')
+    # each translation of an aggregate numbers its closure afresh
+    aspi.repl('sum{1..10}?')
+    aspi.repl('sum{1..10}?')
+    assert (aspi.cache.hits, aspi.cache.misses) == (2, 3)
+
+
+@pytest.mark.parametrize('solver', ['control', 'clingo'])
+def test_stats(capsys, tmp_path, solver):
+    import json
+    from aspi import ASPI
+    aspi = ASPI(solver=solver)
+    aspi.repl(f'#stats "{tmp_path / "stats.jsonl"}".')
+    aspi.repl('sum{1..10}?')
+    stats = aspi.last_stats
+    assert stats is not None and stats['cmd'] == 'sum{1..10}?'
+    assert stats['rules'] > 0 and stats['models'] == 1
+    assert stats['wall'] >= stats['ground'] + stats['solve']
+    assert stats['costs'] == []
+    assert 'rules' in capsys.readouterr().err
+    for cmd in ['init: at(0).',
+                'forward(N) :: action demands.at(N) deletes.at(N) '
+                'adds.at(N+1) costs.1 :- N = 0..29.', 'at(2)!']:
+        aspi.repl(cmd)
+    stats = aspi.last_stats
+    assert stats['costs'] == stats['bounds'] == [2]
+    assert stats['optimal'] > 0
+    assert 'costs [2], bounds [2]' in capsys.readouterr().err
+    aspi.repl('#stats off.')
+    aspi.repl('sum{1..10}?')
+    assert capsys.readouterr().err == ''
+    with open(tmp_path / 'stats.jsonl') as f:
+        assert [json.loads(line)['cmd'] for line in f] == \
+            ['sum{1..10}?', 'init: at(0).',
+             'forward(N) :: action demands.at(N) deletes.at(N) '
+             'adds.at(N+1) costs.1 :- N = 0..29.', 'at(2)!']
+
+
+def test_profile(capsys, tmp_path):
+    import json
+    from aspi import ASPI
+    aspi = ASPI()
+    for cmd in ['fib[0]: 0.', 'fib[1]: 1.',
+                'fib[N 2..20]: fib[N-1] + fib[N-2].',
+                f'#profile "{tmp_path / "profile.jsonl"}".', 'fib[20]?']:
+        aspi.repl(cmd)
+    profile = aspi.last_profile
+    assert profile is not None
+    assert {'source': 'fib[N 2..20]: fib[N-1] + fib[N-2].',
+            'rules': 19, 'atoms': 21} in profile['sentences']
+    assert {'predicate': 'fib/2', 'rules': 21, 'atoms': 21} \
+        in profile['predicates']
+    assert 'lib/plans.ldcs: ' in ' '.join(
+        row['source'] for row in profile['sentences'])
+    assert 'fib[N 2..20]' in capsys.readouterr().err
+    with open(tmp_path / 'profile.jsonl') as f:
+        assert json.loads(f.read()) == profile
+
+    # commands are grounded at the horizon of their plan
+    for cmd in ['init: at(0).',
+                'forward(N) :: action demands.at(N) deletes.at(N) '
+                'adds.at(N+1) :- N = 0..29.', 'at(3)!']:
+        aspi.repl(cmd)
+    profile = aspi.last_profile
+    assert {'predicate': 'apply/2', 'rules': 124, 'atoms': 124} \
+        in profile['predicates']
+
+
+def test_magic_sets(capsys):
+    from aspi import ASPI, magic_sets
+    atoms = []
+    for magic in ['#magic off.', '#magic on.']:
+        aspi = ASPI()
+        for cmd in [magic, 'fib[0]: 0.', 'fib[1]: 1.',
+                    'fib[N 2..45]: fib[N-1] + fib[N-2].', 'fib[10]?']:
+            aspi.repl(cmd)
+        assert capsys.readouterr().out.endswith('that: 55.\n\n')
+        assert aspi.last_stats is not None
+        atoms.append(aspi.last_stats['atoms'])
+    assert atoms[1] < atoms[0]
+    lp = 'f(X+1,X) :- X = 1..9.\nwhat(X) :- f(X,3).\n'
+    assert '__magic_f(3).' in magic_sets(lp)
+    # a function that is also used under negation is left as it is
+    assert magic_sets(lp + 'no :- not f(4,3).\n') == lp + 'no :- not f(4,3).\n'
+
+
+def test_narrow():
+    from ldcs import narrow
+    assert narrow(['A = MuN', 'A < 50', 'A = 1 .. 9999']) == \
+        ['A = MuN', 'A < 50', 'A = 1 .. 49']
+    assert narrow(['(A \\ 100) = 0', 'A = 1 .. 9999'])[-1] == \
+        'A = 100*(1 .. 99)'
+    assert narrow(['A > 990', '(A \\ 2) = 1', 'A = 1 .. 999'])[-1] == \
+        'A = 2*(495 .. 499)+1'
+    # bodies with disjunctions are left alone
+    body = ['A < 50; A > 60', 'A = 1 .. 99']
+    assert narrow(body) == body
+
+
+def test_server(tmp_path):
+    import json
+    import socket
+    import threading
+    from aspi import Server
+    server = Server()
+    address = str(tmp_path / 'aspi.sock')
+    with server.listen(address) as listener:
+        threading.Thread(target=listener.serve_forever).start()
+        try:
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(address)
+                f = client.makefile('rw')
+                for i, cmd in enumerate(['fib[0]: 0.', 'fib[1]: 1.',
+                                         'fib[N 2..20]: fib[N-1] + fib[N-2].',
+                                         'fib[10]?', 'fib[20]?']):
+                    f.write(json.dumps({'id': i, 'cmd': cmd}) + '\n')
+                f.write('nonsense\n')
+                f.flush()
+                replies = [json.loads(f.readline()) for _ in range(6)]
+                f.close()
+        finally:
+            listener.shutdown()
+            server.close()
+    outputs = {reply.get('id'): reply.get('output') for reply in replies}
+    assert outputs[0].endswith('understood.\n\n')
+    assert outputs[3].endswith('that: 55.\n\n')
+    assert outputs[4].endswith('that: 6765.\n\n')
+    assert {'error': 'bad request'} in replies
+    assert server.aspi.counter == 3
+
+
+def test_server_error(capsys):
+    import sys
+    from aspi import Server
+    stdout = sys.stdout
+    server = Server()
+    assert sys.stdout is stdout
+
+    def solve():
+        raise ValueError('no answer')
+
+    replies = []
+    server.answer(server.aspi, 1, ('', None, 0, solve), '', replies.append)
+    server.close()
+    assert replies == [{'id': 1, 'error': 'ValueError: no answer',
+                        'output': ''}]
+    assert 'no answer' in capsys.readouterr().err
+
+
+def test_eval_async(capsys):
+    import asyncio
+    import time
+    from aspi import ASPI, Session
+    aspi = ASPI()
+    for cmd in ['fib[0]: 0.', 'fib[1]: 1.',
+                'fib[N 2..20]: fib[N-1] + fib[N-2].']:
+        aspi.repl(cmd)
+    models = []
+
+    async def answer():
+        return await aspi.eval_async('fib[20]?', on_model=models.append)
+
+    assert [str(x) for x in asyncio.run(answer()).shows] == ['6765']
+    assert models and 'what(6765)' in map(str, models[-1])
+
+    # pigeonhole problems are hard to refute
+    for rule in ['pigeon(1..14).', 'hole(1..13).',
+                 '1 { at(P,H) : hole(H) } 1 :- pigeon(P).',
+                 ':- at(P,H), at(Q,H), P < Q.']:
+        aspi.program.add(rule)
+
+    async def cancel():
+        task = asyncio.ensure_future(aspi.eval_async('fib[20]?', timeout=60))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    start = time.monotonic()
+    asyncio.run(cancel())
+    assert time.monotonic() - start < 5
+    capsys.readouterr()
+    assert asyncio.run(aspi.eval_async('fib[20]?', timeout=0.5)) is None
+    assert capsys.readouterr().out.endswith('timeout.\n\n')
+
+    # the event loop carries on while a session solves in translating
+    aspi.session = Session()
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def meanwhile():
+        ticker = asyncio.ensure_future(tick())
+        try:
+            return await aspi.eval_async('fib[20]?', timeout=0.5)
+        finally:
+            ticker.cancel()
+
+    assert asyncio.run(meanwhile()) is None
+    assert len(ticks) > 5
+
+
+def test_threads():
+    import concurrent.futures
+    import aspi
+    models = aspi.statistics['models']
+    programs = [f'p({i}).\nq(X) :- p(X).\n#show q/1.\n' for i in range(64)]
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        solutions = list(pool.map(aspi.run_control, programs))
+    assert [str(witness[0]) for witness, _ in solutions] == \
+        [f'q({i})' for i in range(64)]
+    assert aspi.statistics['models'] == models + 64
+
+
+@pytest.mark.parametrize('solver', ['clingo', 'control', 'session'])
+def test_solver_options(capsys, solver):
+    from aspi import ASPI
+    aspi = ASPI(solver=solver)
+    assert aspi.options['!'] == ('--configuration=tweety',)
+    aspi.repl('#options ? --parallel-mode=2,compete --configuration=many.')
+    aspi.repl('#options ? --no-such-option.')
+    aspi.repl('#options ! --parallel-mode=2 --opt-strategy=usc.')
+    assert aspi.options == {
+        '?': ('--parallel-mode=2,compete', '--configuration=many'),
+        '!': ('--parallel-mode=2', '--opt-strategy=usc'),
+    }
+    for cmd in ['fib[0]: 0.', 'fib[1]: 1.',
+                'fib[N 2..20]: fib[N-1] + fib[N-2].', 'fib[20]?']:
+        aspi.repl(cmd)
+    captured = capsys.readouterr()
+    assert 'no-such-option' in captured.err
+    assert captured.out.endswith('that: 6765.\n\n')
+
+
+def test_eval_many(capsys):
+    from aspi import ASPI
+    aspi = ASPI()
+    for cmd in ['fib[0]: 0.', 'fib[1]: 1.',
+                'fib[N 2..20]: fib[N-1] + fib[N-2].']:
+        aspi.repl(cmd)
+    solve = aspi.solve
+    calls = []
+    aspi.solve = lambda *args: calls.append(args) or solve(*args)
+    results = aspi.eval_many(['fib[10]?', 'fib[20]?', 'that?',
+                              ':- fib(2,1)?', 'fib[3]?', 'fib[4]?'])
+    assert [(res.status, [str(x) for x in res.shows]) for res in results] \
+        == [(None, ['55']), (None, ['6765']), (None, ['6765']),
+            ('no', []), (None, ['2']), (None, ['3'])]
+    # the questions either side of the one about the last answer are
+    # solved together
+    assert len(calls) == 3
+    assert aspi.counter == 7
+    assert set(['history(1,what(55))', 'history(2,what(6765))',
+                'history(6,what(3))']) <= aspi.facts
+
+
+def test_batch(script_runner, tmp_path):
+    script = tmp_path / 'fib.ldcs'
+    script.write_text('fib[0]: 0.\nfib[1]: 1.\n'
+                      'fib[N 2..20]: fib[N-1] + fib[N-2].\n'
+                      '% questions\nfib[10]?\nfib[20]?\n')
+    ret = script_runner.run('./aspi.py', '--batch', stdin=open(script))
+    assert ret.success
+    assert ret.stdout.endswith('>>> % questions\n'
+                               '>>> fib[10]?\n'
+                               '--> what(A) :- fib(A,10).\nthat: 55.\n\n'
+                               '>>> fib[20]?\n'
+                               '--> what(A) :- fib(A,20).\nthat: 6765.\n\n'
+                               ">>> thanks.\nYOU'RE WELCOME!\n")
+    ret = script_runner.run('./aspi.py', stdin=open(script))
+    assert ret.stdout == script_runner.run(
+        './aspi.py', '--batch', stdin=open(script)).stdout
+    # questions are answered even if the input ends in another sentence
+    script.write_text('fib[0]: 0.\nfib[0]?\nfib[1]: \n')
+    ret = script_runner.run('./aspi.py', '--batch', stdin=open(script))
+    assert ret.success
+    assert ret.stdout.endswith('>>> fib[0]?\n'
+                               '--> what(A) :- fib(A,0).\nthat: 0.\n\n')
+
+
+def test_bench(tmp_path):
+    import json
+    import bench
+    output = tmp_path / 'bench.json'
+    assert bench.main(['-j', '2', '-o', str(output),
+                       'euler/001', 'hanoi']) == 0
+    results = json.loads(output.read_text())
+    assert results['hanoi']['passed']
+    assert results['hanoi']['solve'] > 0
+    assert [q['cmd'] for q in results['euler/001']['queries']] == \
+        ['sum{0..999 multiple[3|5]}?', 'thanks.']
+    assert all(q['peak_rss'] <= results['hanoi']['peak_rss']
+               for q in results['hanoi']['queries'])
+    baseline = {'hanoi': dict(results['hanoi'], peak_rss=1)}
+    assert bench.compare(results, baseline) == \
+        [f'hanoi: peak_rss 1 -> {results["hanoi"]["peak_rss"]}']
+
+
+def test_replace_names():
+    from aspi import ASPI, Results
+    from clingo import parse_term
+    res = Results(ASPI(), [parse_term('describe(b1,big,block)'),
+                           parse_term('describe(f(b1),top,of,b1)'),
+                           parse_term('describe(b10,small,b1)'),
+                           parse_term('describe(c,c)')])
+    assert res.replace_names('on(f(b1),b10,b100,c)') == \
+        'on(top of big block,small big block,b100,c)'
+
+
+def test_show_pages(capsys, tmp_path):
+    from aspi import ASPI
+    aspi = ASPI()
+    aspi.repl('#page 3.')
+    aspi.repl('1..10?')
+    aspi.repl('#limit 4.')
+    aspi.repl('1..10?')
+    aspi.repl(f'#output "{tmp_path}/that.txt".')
+    aspi.repl('#limit off.')
+    aspi.repl('1..2?')
+    aspi.repl('#output stdout.')
+    out = capsys.readouterr().out
+    assert 'that: 1 | 2 | 3 | 4 | 5 | 6 | 7 | 8 | 9 | 10.\n' in out
+    assert 'that: 1 | 2 | 3 | 4 | (6 more).\n' in out
+    assert (tmp_path / 'that.txt').read_text() == 'that: 1 | 2.\n'
+    for cmd in ['#page 0.', '#page 2.5.', '#limit x.', '#cache -1.']:
+        aspi.repl(cmd)
+    assert capsys.readouterr().err.split('\n')[:-1] == [
+        'usage: #page N., with N >= 1', 'usage: #page N., with N >= 1',
+        'usage: #limit N|off., with N >= 0', 'usage: #cache N., with N >= 0']
+    assert (aspi.page, aspi.limit, aspi.cache.size) == (3, None, 256)
+
+
+def test_gather_context(capsys):
+    import sys
+    from aspi import ASPI, Context
+    from clingo import Function, Number, Tuple_
+    context = Context()
+    i = Number(1)
+    for a in [Tuple_([Number(2), Number(0)]), Tuple_([Number(1), Number(0)]),
+              Tuple_([Number(2), Number(0)]), Tuple_([Number(2), Number(1)]),
+              Function('gather_sentinel')]:
+        assert context.gather(i, a) == i
+    assert str(context.setof(i)) == 'set((1,0),(2,0),(2,1))'
+    assert str(context.bagof(i)) == 'bag(1,2,2)'
+    assert str(context.setof(Number(2))) == 'empty'
+    assert str(context.bagof(Number(2))) == 'error'
+
+    aspi = ASPI()
+    aspi.repl('count{1..5 | 7}?')
+    aspi.repl('count{1..3}?')
+    out = capsys.readouterr().out
+    assert 'that: 6.\n' in out
+    assert 'that: 3.\n' in out
+    assert not getattr(sys.modules['__main__'], 'gathered', None)
+
+
+def test_script_context(capsys, monkeypatch):
+    import sys
+    import types
+    import aspi
+    from clingo import String
+    session = aspi.ASPI()
+    assert 'lib/prelude.lp' in aspi.scripts
+    context = aspi.Context()
+    assert context.reverse(String('ab')) == String('ba')
+    with pytest.raises(AttributeError):
+        context.no_such_function
+    # the functions don't depend on where clingo runs the prelude's script
+    monkeypatch.setitem(sys.modules, '__main__', types.ModuleType('__main__'))
+    session.repl('count{1..3}?')
+    assert 'that: 3.\n' in capsys.readouterr().out
+
+
+def test_native_aggregates(capsys):
+    from aspi import ASPI
+    aspi = ASPI()
+    assert '#count{' in aspi.ldcs.toASP('count{1..5 | 7}?')
+    assert '#count{' in aspi.ldcs.toASP('count{n1 ~even}?')
+    # an aggregate that its own elements depend on is gathered instead
+    aspi.ldcs.toASP('paths.B: path.A + edge[A,B].')
+    assert '#min{' in aspi.ldcs.toASP('far[node B]: min{paths.B}.')
+    counts = dict(aspi.ldcs.counts)
+    assert '#min{' not in aspi.ldcs.toASP('path[node B]: min{paths.B}.')
+    # the first translation is forgotten, along with the numbers it took
+    assert {name for name, n in aspi.ldcs.counts.items()
+            if counts.get(name) != n} == {'gather', 'proof'}
+    # only the aggregates of the sentence being translated are checked, so
+    # one that a later statement makes recursive is left to clingo
+    translator = ASPI().ldcs
+    assert '#min{' in translator.toASP('path[node B]: min{paths.B}.')
+    translator.toASP('paths.B: path.A + edge[A,B].')
+    assert '#min{' not in translator.toASP('far[node B]: min{paths.B}.')
+    for cmd in ['count{1..5 | 7}?', 'count{n1 ~even}?', 'count{n1 (> 9)}?',
+                'sum{{n1 even}}?', 'max{n1 even}?']:
+        aspi.repl(cmd)
+    out = capsys.readouterr().out
+    assert out.count('#count{') == 3
+    for that in ['6', '5', '0', '20', '8']:
+        assert f'that: {that}.\n' in out